@@ -1,8 +1,14 @@
-import ReRCoP_checkPrerequisite 
+import ReRCoP_checkPrerequisite
+import ReRCoP_alignment
+import ReRCoP_blast
+import ReRCoP_checkpoint
 import ReRCoP_preprocessing
 import ReRCoP_matrix
 import ReRCoP_outlierDetection
 import ReRCoP_postprocessing
+import ReRCoP_profile
+import ReRCoP_state
+import ReRCoP_sweep
 import copy
 import sys
 import os
@@ -13,216 +19,536 @@ from optparse import OptionGroup
 #################################################################
 ##### Input options
 #################################################################
-# Parse input options
 usage = "usage: %prog [options] Genomes.fasta"
-parser = OptionParser(usage=usage, version="%prog 1.0")
-
-group = OptionGroup(parser, "Input Options")
-group.add_option("-a", "--aligned", action="store_true", dest="aligned", help="Set this if genome sequences in the input file are aligned.")
-group.add_option("--gbk",action="store",type="string",dest="gbk",help="Input GenBank file of the reference genome.")
-group.add_option("-w", "--window", action="store_true", dest="window", help="Set this if sliding windows instead of genes are to be considered.")
-group.add_option("--fSize",action="store",type="int",dest="fSize",default=1000,help="Fragment size if using sliding window. [Default: 1000]")
-group.add_option("--sSize",action="store",type="int",dest="sSize",default=500,help="Step size if using sliding window. [Default: 500]")
-group.add_option("--cds",action="store",type="string",dest="cds",help="Input coding sequences in fasta format. Used to determine the core genome when input genomes are not aligned.")
-parser.add_option_group(group)
-
-group = OptionGroup(parser, "Core Gene Identification Options")
-group.add_option("--cov",action="store",type="float",dest="cov",default=0.7,help="Minimum sequence coverage to regard genes as present [Default: 0.7]")
-group.add_option("--sim",action="store",type="int",dest="sim",default=70,help="Minimum sequence similarity to regard genes as present [Default: 70]")
-parser.add_option_group(group)
-
-group = OptionGroup(parser, "Outlier Removal Options")
-group.add_option("-m", "--method",action="store",type="string",dest="method",help="Outlier removal method. Can be 'Grubbs', 'kNN', or 'DBSCAN', or can be multiple methods separated by ','")
-group.add_option("--alpha", action="store",type="float",dest="alpha",default=0.05,help="For 'Grubbs' method: Significance level in Grubbs test. [Default: 0.05]")
-group.add_option("--radius", action="store",type="float",dest="radius",default=1.5,help="For 'kNN' method: Maximum number of differences for a point to be considered as a neighbor (in the unit of standard deviation of all pair-wise nubmer of differences). [Default: 1.5)]")
-group.add_option("--k",action="store",type="float",dest="k", default=0.2, help="For 'kNN' method: Minimum number of neighbors for a non-outlier point (in the unit of total number of points). [Default: 0.2]")
-group.add_option("--eps",action="store",type="float",dest="eps",default=1, help="For 'DBSCAN' method: Maximum number of differences between two points for them to be considered as in the same neighborhood (in the unit of standard deviation of all pair-wise nubmer of differences). [Default: 1]")
-group.add_option("--minP",action="store",type="float",dest="minP",default=0.2, help="For 'DBSCAN' method: Minimum number of points required to form a dense region (in the unit of total number of points). [Default: 0.2]")
-parser.add_option_group(group)
-
-group = OptionGroup(parser, "Output Options")
-group.add_option("-o", "--outdir",action="store",type="string",dest="outdir",default=".", help="Output directory. [Default: running directory]")
-group.add_option("-p", "--prefix",action="store",type="string",dest="prefix",default="ReRCoP", help="Output prefix. [Default: ReRCoP]")
-parser.add_option_group(group)
-
-(options, args) = parser.parse_args()
-
-
-# Check input options
-if len(args) == 0:
-    print usage
-    sys.exit()
-
-if options.aligned:
-    if options.cds:
-        parser.error("Options --aligned and --cds are mutually exclusive.")
-    if options.gbk and options.window:
-        parser.error("Options --gbk and --window are mutually exclusive.")
-    if not options.gbk and not options.window:
-        parser.error("Either --gbk or --window should be set while using --aligned.")
-    if options.window:
-        if options.sSize <=0 or options.sSize>options.fSize:
-            parser.error("Option --sSize should be larger than 0 and no larger than --fSize")
-else:
-    if not options.cds:
-        parser.error("Option --cds should be indicated while not --aligned.")
-
-if options.cov<0 or options.cov>1:
-    parser.error("Option --cov should be within the range of 0-1.")
-if options.sim<0 or options.sim>100:
-    parser.error("Option --sim should be within the range of 0-100")
-
-if not options.method:
-    parser.error("Option --method is required.")
-
-if options.alpha<0 or options.alpha>1:
-    parser.error("Option --alpha should be within the range of 0-1.")
-if options.radius <0:
-    parser.error("Option --radius should be no less than 0.")
-if options.k<0 or options.k>1:
-    parser.error("Option --k should be within the range of 0-1.")
-if options.eps <0:
-    parser.error("Option --eps should be no less than 0.")
-if options.minP <0 or options.minP >1:
-    parser.error("Option --minP should be within the range of 0-1.")
-
-
-# Get the values of the options
-inputGenome = args[0]		# Input complete genome sequences
-
-aligned = options.aligned	# Input genome sequences are aligned or not
-inputGbk = options.gbk		# Input genebank file
-window = options.window		# Using sliding windows
-fragSize = int(options.fSize)	# Fragment size of sliding windows
-stepSize = int(options.sSize)	# Step size of sliding windows
-inputGene = options.cds		# input coding sequences
-
-covCut = float(options.cov)	# 0-1, coverage cutoff in core genome identification
-simCut = float(options.sim)	# 0-100, similarity cutoff in core genome identification
-
-outlierMethod = options.method.split(',')	# Outlier removal method
-for item in outlierMethod:
-    if item not in ['Grubbs', 'kNN', 'DBSCAN']:
-        parser.error("Option --method should be 'Grubbs', 'kNN', or 'DBSCAN'")
-
-alpha = float(options.alpha)	# Grubbs: Significance level
-radius = float(options.radius)	# kNN: parameter
-k = options.k			# kNN: parameter
-eps = options.eps		# DBSCAN: radius
-minP = options.minP		# minP: minPts
-
-outdir = options.outdir		# output directory
-prefix = options.prefix		# output prefix
 
 
-#################################################################
-##### Check prerequisite
-#################################################################
-
-# Check python module
-ReRCoP_checkPrerequisite.checkModule('scipy')
-
-# Check the necessary software
-if inputGene:
-    ReRCoP_checkPrerequisite.checkCommand('which makeblastdb')
-    ReRCoP_checkPrerequisite.checkCommand('which blastn')
-
-# Check input files and duplicate names in the fasta files
-ReRCoP_checkPrerequisite.checkFile(inputGenome)
-ReRCoP_checkPrerequisite.checkName(inputGenome)
-if inputGbk:
-    ReRCoP_checkPrerequisite.checkFile(inputGbk)
-if inputGene:
-    ReRCoP_checkPrerequisite.checkFile(inputGene)
-    ReRCoP_checkPrerequisite.checkName(inputGene)
-
-# Check the output directory
-ReRCoP_checkPrerequisite.checkDir(outdir)
+def optionParser():
+    '''
+    This function returns the parser of the command line options. The default
+    values of the options are also the defaults of 'runReRCoP'.
+
+    @return an OptionParser
+    '''
+    parser = OptionParser(usage=usage, version="%prog 1.0")
+
+    group = OptionGroup(parser, "Input Options")
+    group.add_option("-a", "--aligned", action="store_true", dest="aligned", help="Set this if genome sequences in the input file are aligned.")
+    group.add_option("--gbk",action="store",type="string",dest="gbk",help="Input GenBank file of the reference genome.")
+    group.add_option("-w", "--window", action="store_true", dest="window", help="Set this if sliding windows instead of genes are to be considered.")
+    group.add_option("--fSize",action="store",type="int",dest="fSize",default=1000,help="Fragment size if using sliding window. [Default: 1000]")
+    group.add_option("--sSize",action="store",type="int",dest="sSize",default=500,help="Step size if using sliding window. [Default: 500]")
+    group.add_option("--stream", action="store_true", dest="stream", help="Set this to process sliding windows in blocks and write the outputs one sequence at a time, bounding the memory use by the block size. Only used with --window.")
+    group.add_option("--blockSize",action="store",type="int",dest="blockSize",default=4194304,help="Number of alignment cells (genomes x columns) in each block if using --stream. [Default: 4194304]")
+    group.add_option("--update",action="store",type="string",dest="update",help="Add the aligned genomes in the input file to the run saved in this state file (see --saveState). The regions are taken from the saved run.")
+    group.add_option("--cds",action="store",type="string",dest="cds",help="Input coding sequences in fasta format. Used to determine the core genome when input genomes are not aligned.")
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Core Gene Identification Options")
+    group.add_option("--cov",action="store",type="float",dest="cov",default=0.7,help="Minimum sequence coverage to regard genes as present [Default: 0.7]")
+    group.add_option("--sim",action="store",type="int",dest="sim",default=70,help="Minimum sequence similarity to regard genes as present [Default: 70]")
+    group.add_option("--threads",action="store",type="int",dest="threads",default=1,help="Number of BLAST searches to run at the same time, or number of blastn threads with --combined. Also the number of compressing threads of each output with --compress, and of processes running the --sweep combinations. [Default: 1]")
+    group.add_option("--combined",action="store_true",dest="combined",help="Set this to put all genomes in one BLAST database that is searched by a single multi-threaded blastn run.")
+    group.add_option("--cache",action="store",type="string",dest="cache",help="Directory keeping BLAST databases and hits for reuse by later runs.")
+    group.add_option("--cacheSize",action="store",type="int",dest="cacheSize",default=10240,help="Maximum size of the --cache directory in MB. [Default: 10240]")
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Outlier Removal Options")
+    group.add_option("-m", "--method",action="store",type="string",dest="method",help="Outlier removal method. Can be 'Grubbs', 'kNN', or 'DBSCAN', or can be multiple methods separated by ','")
+    group.add_option("--alpha", action="store",type="float",dest="alpha",default=0.05,help="For 'Grubbs' method: Significance level in Grubbs test. [Default: 0.05]")
+    group.add_option("--iterative", action="store_true",dest="iterative",help="For 'Grubbs' method: Set this to repeat the Grubbs test on the remaining points of each region until no more outliers are found.")
+    group.add_option("--radius", action="store",type="float",dest="radius",default=1.5,help="For 'kNN' method: Maximum number of differences for a point to be considered as a neighbor (in the unit of standard deviation of all pair-wise nubmer of differences). [Default: 1.5)]")
+    group.add_option("--k",action="store",type="float",dest="k", default=0.2, help="For 'kNN' method: Minimum number of neighbors for a non-outlier point (in the unit of total number of points). [Default: 0.2]")
+    group.add_option("--eps",action="store",type="float",dest="eps",default=1, help="For 'DBSCAN' method: Maximum number of differences between two points for them to be considered as in the same neighborhood (in the unit of standard deviation of all pair-wise nubmer of differences). [Default: 1]")
+    group.add_option("--minP",action="store",type="float",dest="minP",default=0.2, help="For 'DBSCAN' method: Minimum number of points required to form a dense region (in the unit of total number of points). [Default: 0.2]")
+    group.add_option("--sweep",action="store",type="string",dest="sweep",help="Run the methods with every combination of the given parameter values, e.g. 'alpha=0.01,0.05;k=0.1,0.2;radius=1,1.5;eps=0.5,1'. The SNP matrix is computed once and the combinations are run by --threads processes. Parameters not given keep their option values. The outcome of each combination is written to <prefix>.sweep.tsv instead of the outlier matrices and removal files.")
+    group.add_option("--sweepWrite",action="store",type="string",dest="sweepWrite",help="Write the removal fasta file of these --sweep combinations, given by their ID in <prefix>.sweep.tsv and separated by ','.")
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Output Options")
+    group.add_option("-o", "--outdir",action="store",type="string",dest="outdir",default=".", help="Output directory. [Default: running directory]")
+    group.add_option("-p", "--prefix",action="store",type="string",dest="prefix",default="ReRCoP", help="Output prefix. [Default: ReRCoP]")
+    group.add_option("--compress",action="store_true",dest="compress",help="Set this to write the fasta outputs compressed in BGZF format (readable by gzip and samtools), with '.gz' added to their names.")
+    group.add_option("--matFormat",action="store",type="string",dest="matFormat",default="text", help="Format of the SNP and outlier matrices, 'text' or 'npz'. The 'npz' format is a NumPy archive with float32 SNPs and bit-packed outlier flags. [Default: text]")
+    group.add_option("--profile",action="store_true",dest="profile",help="Set this to write the wall time, CPU time, peak memory and item counts of each stage of the run to <prefix>.run.json.")
+    group.add_option("--progress",action="store",type="int",dest="progress",default=0,help="Print the progress of the long loops every this many genomes or regions. [Default: 0, no progress]")
+    group.add_option("--saveState",action="store_true",dest="saveState",help="Save the state of the run to <prefix>.state.npz so that genomes can be added later with --update.")
+    group.add_option("--checkpoint",action="store_true",dest="checkpoint",help="Set this to save the core alignment and the number of SNPs in each gene to the directory <prefix>.checkpoint, and to resume from them when run again with the same input files and core genome options.")
+    parser.add_option_group(group)
+    return parser
+
+
+def defaultConfig():
+    '''
+    This function returns the default value of every option, keyed by the
+    destination of the option (e.g. 'method' for --method, 'fSize' for
+    --fSize).
+
+    @return a dict
+    '''
+    return vars(optionParser().get_default_values())
+
+
+def methodList(method):
+    '''
+    This function returns the outlier removal methods of the --method option.
+
+    @param method: the methods separated by ',', or a list of methods
+    @return a list of method names
+    '''
+    if isinstance(method, basestring):
+        return method.split(',')
+    return list(method)
+
+
+def checkConfig(config):
+    '''
+    This function checks the values of the options, either parsed from the
+    command line or given to 'runReRCoP'. Setting 'update' also sets
+    'aligned'.
+
+    @param config: a dict of option values as returned by 'defaultConfig'
+    @return the list of outlier removal methods
+    '''
+    if config['update']:
+        if config['cds'] or config['gbk'] or config['window'] or config['stream']:
+            raise ValueError("Options --cds, --gbk, --window and --stream cannot be used with --update.")
+        if config['checkpoint']:
+            raise ValueError("Option --checkpoint cannot be used with --update.")
+        config['aligned'] = True
+    elif config['aligned']:
+        if config['cds']:
+            raise ValueError("Options --aligned and --cds are mutually exclusive.")
+        if config['gbk'] and config['window']:
+            raise ValueError("Options --gbk and --window are mutually exclusive.")
+        if not config['gbk'] and not config['window']:
+            raise ValueError("Either --gbk or --window should be set while using --aligned.")
+        if config['window']:
+            if config['sSize'] <=0 or config['sSize']>config['fSize']:
+                raise ValueError("Option --sSize should be larger than 0 and no larger than --fSize")
+        if config['stream'] and not config['window']:
+            raise ValueError("Option --stream should be used with --window.")
+        if config['blockSize'] <= 0:
+            raise ValueError("Option --blockSize should be larger than 0.")
+    else:
+        if not config['cds']:
+            raise ValueError("Option --cds should be indicated while not --aligned.")
+        if config['stream']:
+            raise ValueError("Option --stream should be used with --aligned and --window.")
+
+    if config['cov']<0 or config['cov']>1:
+        raise ValueError("Option --cov should be within the range of 0-1.")
+    if config['sim']<0 or config['sim']>100:
+        raise ValueError("Option --sim should be within the range of 0-100")
+    if config['threads']<1:
+        raise ValueError("Option --threads should be no less than 1.")
+    if config['cacheSize']<0:
+        raise ValueError("Option --cacheSize should be no less than 0.")
+
+    if config['progress']<0:
+        raise ValueError("Option --progress should be no less than 0.")
+    if config['matFormat'] not in ['text', 'npz']:
+        raise ValueError("Option --matFormat should be 'text' or 'npz'.")
+
+    if not config['method']:
+        raise ValueError("Option --method is required.")
+    outlierMethod = methodList(config['method'])
+    for item in outlierMethod:
+        if item not in ['Grubbs', 'kNN', 'DBSCAN']:
+            raise ValueError("Option --method should be 'Grubbs', 'kNN', or 'DBSCAN'")
+
+    if config['alpha']<0 or config['alpha']>1:
+        raise ValueError("Option --alpha should be within the range of 0-1.")
+    if config['radius'] <0:
+        raise ValueError("Option --radius should be no less than 0.")
+    if config['k']<0 or config['k']>1:
+        raise ValueError("Option --k should be within the range of 0-1.")
+    if config['eps'] <0:
+        raise ValueError("Option --eps should be no less than 0.")
+    if config['minP'] <0 or config['minP'] >1:
+        raise ValueError("Option --minP should be within the range of 0-1.")
+    if config['sweep']:
+        ReRCoP_sweep.parseGrid(config['sweep'])
+    if config['sweepWrite']:
+        if not config['sweep']:
+            raise ValueError("Option --sweepWrite should be used with --sweep.")
+        try:
+            selected = [int(item) for item in config['sweepWrite'].split(',')]
+        except ValueError:
+            raise ValueError("Option --sweepWrite should be IDs separated by ','.")
+        if min(selected) < 1:
+            raise ValueError("Option --sweepWrite should be IDs separated by ','.")
+        combos = ReRCoP_sweep.combinations(outlierMethod, ReRCoP_sweep.parseGrid(config['sweep']), config)
+        if max(selected) > len(combos):
+            raise ValueError("Option --sweepWrite should be IDs of the %d --sweep combinations." % len(combos))
+    return outlierMethod
 
 
 #################################################################
-##### Form concatenate core genome and generate concatenation log
+##### Pipeline stages
 #################################################################
-
-seqConcat = {}	# A fasta object of the concatenated genomes
-logConcat = []	# A list of list as the concatenation log
-inGenome = ReRCoP_preprocessing.readFasta(inputGenome)
-if aligned:
-    ReRCoP_checkPrerequisite.checkLen(inGenome)
-
-# Input: complete genome + coding sequences, require identification
-if not aligned and inputGene:
-    inGene = ReRCoP_preprocessing.readFasta(inputGene)
-    tmpFile = outdir + '/' + prefix + ".ReRCoP.tmp"
-    [seqConcat, logConcat] = ReRCoP_preprocessing.parseRaw(inGene, inGenome, simCut, covCut, tmpFile+".1", tmpFile+".2", tmpFile+".3")
-
-# Input: sequence alignment + gbk file, parse based on gbk
-if aligned and inputGbk:
-    inGbk = ReRCoP_preprocessing.readGbk(inputGbk)
-    [seqConcat, logConcat] = ReRCoP_preprocessing.parseGbk(inGbk, inGenome, covCut)
-
-# Input: sequence alignmet, keep non-coding regions in a sliding-window manner.
-if aligned and window:
-    fullLen = ReRCoP_preprocessing.fastaLen(inGenome)
-    logConcat = ReRCoP_preprocessing.slidingWindow(fullLen, fragSize, stepSize)
-    seqConcat = inGenome
-
-
-################################################################
-##### Generate matrix of SNP number for each gene
-################################################################
-SNPmat = ReRCoP_matrix.GeneDiff(logConcat, seqConcat)
-
-################################################################
-##### Outlier detection
-################################################################
-if "Grubbs" in outlierMethod:
-    Outliermat_Grubbs = ReRCoP_matrix.methodMat(SNPmat)
-    for i in range(1,len(SNPmat)):
-        SNPs = SNPmat[i][3:]
-        outlierPos = ReRCoP_outlierDetection.Grubbs(SNPs, alpha)
-        for j in outlierPos:
-            Outliermat_Grubbs[i][j+3] = 1
-    finalConcat_Grubbs = ReRCoP_postprocessing.removeOutlier(seqConcat, Outliermat_Grubbs)
-    ReRCoP_postprocessing.writeMat(Outliermat_Grubbs, outdir+'/'+prefix+".Grubbs.outliermat")
-    ReRCoP_postprocessing.writeFasta(finalConcat_Grubbs, outdir+'/'+prefix+".Grubbs.removal.fasta")
-
-
-if "kNN" in outlierMethod:
-    Outliermat_kNN = ReRCoP_matrix.methodMat(SNPmat)
-    for i in range(1,len(SNPmat)):
-        SNPs = SNPmat[i][3:]
-        outlierPos = ReRCoP_outlierDetection.kNN(SNPs, k, radius)
-        for j in outlierPos:
-            Outliermat_kNN[i][j+3] = 1
-    finalConcat_kNN = ReRCoP_postprocessing.removeOutlier(seqConcat, Outliermat_kNN)
-    ReRCoP_postprocessing.writeMat(Outliermat_kNN, outdir+'/'+prefix+".kNN.outliermat")
-    ReRCoP_postprocessing.writeFasta(finalConcat_kNN, outdir+'/'+prefix+".kNN.removal.fasta")
-
-if 'DBSCAN' in outlierMethod:
-    Outliermat_DBSCAN = ReRCoP_matrix.methodMat(SNPmat)
-    if not minP:
-            minP = len(SNPs)*0.3
-    for i in range(1,len(SNPmat)):
-        SNPs = SNPmat[i][3:]
-        outlierPos = ReRCoP_outlierDetection.DBSCAN(SNPs, eps, minP)
-        for j in outlierPos:
-            Outliermat_DBSCAN[i][j+3] = 1
-
-    finalConcat_DBSCAN = ReRCoP_postprocessing.removeOutlier(seqConcat, Outliermat_DBSCAN)
-    ReRCoP_postprocessing.writeMat(Outliermat_DBSCAN, outdir+'/'+prefix+".DBSCAN.outliermat")
-    ReRCoP_postprocessing.writeFasta(finalConcat_DBSCAN, outdir+'/'+prefix+".DBSCAN.removal.fasta")
-
-
-################################################################
-##### Write to output
-################################################################
-
-## write the SNP mat
-ReRCoP_postprocessing.writeMat(SNPmat, outdir+'/'+prefix+".snpmat")
-
-## write the Concatinated sequences
-ReRCoP_postprocessing.writeFasta(seqConcat, outdir+'/'+prefix+".core.fasta")
-
-## write the log file
-ReRCoP_postprocessing.writeMat(logConcat, outdir+'/'+prefix+".concatenation.log")
+def coreGenome(inGenome, config, profile=None):
+    '''
+    This function forms the concatenated core genome and the concatenation
+    log, from the genes found by BLAST (--cds), the genes of a GenBank record
+    (--gbk) or sliding windows (--window).
+
+    @param inGenome: an Alignment of the genomes if aligned, else a fasta
+    object of the genomes
+    @param config: a dict of option values checked by 'checkConfig', where
+    'cds' and 'gbk' are file names or the records returned by 'readFasta'
+    and 'readGbk'
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    @return [seqConcat, logConcat, regions] with seqConcat an Alignment and
+    regions the alignment regions of the input making up seqConcat, or None
+    if the input is not aligned
+    '''
+    seqConcat = {}	# An Alignment of the concatenated genomes
+    logConcat = []	# A list of list as the concatenation log
+    regions = None	# Alignment regions of the input making up seqConcat
+
+    # Input: complete genome + coding sequences, require identification
+    if not config['aligned'] and config['cds']:
+        inGene = config['cds']
+        if isinstance(inGene, basestring):
+            inGene = ReRCoP_preprocessing.readFasta(inGene)
+        tmpFile = config['outdir'] + '/' + config['prefix'] + ".ReRCoP.tmp"
+        cache = None
+        if config['cache']:
+            cache = ReRCoP_blast.BlastCache(config['cache'], int(config['cacheSize'])*1024*1024)
+        [seqConcat, logConcat] = ReRCoP_preprocessing.parseRaw(inGene, inGenome, float(config['sim']), float(config['cov']), tmpFile+".1", tmpFile+".2", tmpFile+".3", int(config['threads']), config['combined'], cache, profile)
+        seqConcat = ReRCoP_alignment.toAlignment(seqConcat)
+
+    # Input: sequence alignment + gbk file, parse based on gbk
+    if config['aligned'] and config['gbk']:
+        inGbk = config['gbk']
+        if isinstance(inGbk, basestring):
+            inGbk = ReRCoP_preprocessing.readGbk(inGbk)
+        [regions, logConcat] = ReRCoP_preprocessing.coreRegions(inGbk, inGenome, float(config['cov']))
+        seqConcat = ReRCoP_preprocessing.extractRegions(inGenome, regions)
+
+    # Input: sequence alignmet, keep non-coding regions in a sliding-window manner.
+    if config['aligned'] and config['window']:
+        fullLen = ReRCoP_preprocessing.fastaLen(inGenome)
+        logConcat = ReRCoP_preprocessing.slidingWindow(fullLen, int(config['fSize']), int(config['sSize']))
+        seqConcat = inGenome
+        regions = [[0, fullLen]]
+    return [seqConcat, logConcat, regions]
+
+
+def countDiff(seqConcat, logConcat, config, profile=None):
+    '''
+    This function counts the differences from the consensus in each region of
+    each genome, streaming through the regions in blocks with --stream.
+
+    @param seqConcat: an Alignment of the concatenated genomes
+    @param logConcat: the concatenation log
+    @param config: a dict of option values checked by 'checkConfig'
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    @return [diff, counts] with diff as returned by ReRCoP_matrix.regionDiff
+    and counts the BaseCounts of seqConcat, or None if streaming without
+    saving the state
+    '''
+    if config['stream']:
+        counts = None
+        if config['saveState']:
+            counts = ReRCoP_alignment.BaseCounts(seqConcat.length)
+        diff = ReRCoP_matrix.blockDiff(logConcat, seqConcat, int(config['blockSize']), counts, profile)
+    else:
+        [ref, counts] = ReRCoP_preprocessing.consensus(seqConcat)
+        diff = ReRCoP_matrix.regionDiff(logConcat, seqConcat, ref, profile)
+    return [diff, counts]
+
+
+def detectOutliers(SNPmat, config, profile=None):
+    '''
+    This function runs the outlier removal methods on the SNP matrix.
+
+    @param SNPmat: the SNP matrix returned by ReRCoP_matrix.scaleDiff
+    @param config: a dict of option values checked by 'checkConfig'
+    @param profile: a ReRCoP_profile.Profile to record the number of
+    outliers of each method
+    @return [methods, masks] with methods the methods run and masks a dict
+    of the boolean outlier array of each method, one row per region and one
+    column per genome
+    '''
+    SNParr = ReRCoP_matrix.snpArray(SNPmat)
+    outlierMethod = methodList(config['method'])
+    methods = [item for item in ["Grubbs", "kNN", "DBSCAN"] if item in outlierMethod]
+    minP = config['minP']
+    if 'DBSCAN' in methods and not minP:
+        minP = SNParr.shape[1]*0.3
+    masks = ReRCoP_outlierDetection.outlierMats(SNParr, methods, float(config['alpha']), config['iterative'], config['k'], float(config['radius']), config['eps'], minP)
+    if profile is not None:
+        for item in methods:
+            profile.count('outliers.'+item, int(masks[item].sum()))
+    return [methods, masks]
+
+
+def runReRCoP(alignment, config=None, profile=None):
+    '''
+    This function runs ReRCoP on a set of genomes and returns the results as
+    objects in memory instead of writing them out, so that it can be called
+    for many datasets from one Python process. Only the BLAST searches of
+    unaligned genomes use temporary files, in the 'outdir' directory. The
+    fasta index of an aligned fasta file is reused if cached by an earlier
+    run, but is not written.
+
+    @param alignment: the genomes as a fasta file, a fasta object or an
+    Alignment
+    @param config: a dict of option values replacing those of
+    'defaultConfig', e.g. {'aligned':True, 'window':True, 'method':'kNN'}.
+    'gbk' and 'cds' may be file names or the records returned by 'readGbk'
+    and 'readFasta'. --update and the output options are not used
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    @return a dict with the keys 'core' (the Alignment of the concatenated
+    genomes), 'log' (the concatenation log), 'regions', 'snpmat' (the SNP
+    matrix), 'diff', 'counts', 'masks' (the outlier array of each method as
+    returned by 'detectOutliers'), 'outliermats' (the Outliermat of each
+    method) and 'removal' (the Alignment with the outliers of each method
+    removed)
+    '''
+    settings = defaultConfig()
+    for key in (config or {}):
+        if key not in settings:
+            raise ValueError("Unknown option '%s'!" % key)
+        settings[key] = config[key]
+    if settings['update'] or settings['sweep']:
+        raise ValueError("Options --update and --sweep cannot be used with runReRCoP.")
+    checkConfig(settings)
+
+    if isinstance(alignment, basestring) and settings['aligned']:
+        inGenome = ReRCoP_preprocessing.readMapped(alignment, write=False)
+    elif isinstance(alignment, basestring):
+        inGenome = ReRCoP_preprocessing.readFasta(alignment)
+    elif settings['aligned']:
+        inGenome = ReRCoP_alignment.toAlignment(alignment)
+    else:
+        inGenome = alignment
+    if settings['aligned']:
+        ReRCoP_checkPrerequisite.checkLen(inGenome)
+
+    [seqConcat, logConcat, regions] = coreGenome(inGenome, settings, profile)
+    [diff, counts] = countDiff(seqConcat, logConcat, settings, profile)
+    SNPmat = ReRCoP_matrix.scaleDiff(logConcat, seqConcat.names, diff)
+    [methods, masks] = detectOutliers(SNPmat, settings, profile)
+    outliermats = dict((item, ReRCoP_matrix.methodMat(SNPmat, masks[item])) for item in methods)
+    removal = dict((item, ReRCoP_postprocessing.removeOutlier(seqConcat, outliermats[item])) for item in methods)
+    return {'core':seqConcat,
+            'log':logConcat,
+            'regions':regions,
+            'snpmat':SNPmat,
+            'diff':diff,
+            'counts':counts,
+            'masks':masks,
+            'outliermats':outliermats,
+            'removal':removal}
+
+
+def main(argv=None):
+    '''
+    This function runs ReRCoP from the command line.
+
+    @param argv: the command line arguments [Default: sys.argv[1:]]
+    '''
+    parser = optionParser()
+    (options, args) = parser.parse_args(argv)
+
+
+    # Check input options
+    if len(args) == 0:
+        print usage
+        sys.exit()
+
+    config = vars(options)
+    try:
+        outlierMethod = checkConfig(config)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+    # Get the values of the options
+    inputGenome = args[0]		# Input complete genome sequences
+
+    aligned = config['aligned']	# Input genome sequences are aligned or not
+    inputGbk = config['gbk']	# Input genebank file
+    inputGene = config['cds']	# input coding sequences
+    threads = int(config['threads'])	# Number of BLAST searches run at the same time
+
+    outdir = config['outdir']		# output directory
+    prefix = config['prefix']		# output prefix
+    matFormat = config['matFormat']	# Format of the SNP and outlier matrices
+    compress = config['compress']	# Write the fasta outputs in BGZF format
+    fastaExt = ".fasta.gz" if compress else ".fasta"	# Extension of the fasta outputs
+    update = config['update']		# State file of the run to add genomes to
+    saveState = config['saveState'] or update	# Save the state of the run
+    config['saveState'] = saveState
+    profiling = config['profile']	# Write the run report
+    checkpoint = None		# Directory of the checkpoints
+    if config['checkpoint']:
+        checkpoint = outdir+'/'+prefix+".checkpoint"
+    profile = ReRCoP_profile.Profile(int(config['progress']))	# Stage timings and progress
+
+
+    #################################################################
+    ##### Check prerequisite
+    #################################################################
+    profile.stage('check')
+
+    # Check python module
+    ReRCoP_checkPrerequisite.checkModule('numpy')
+    if 'Grubbs' in outlierMethod:
+        ReRCoP_checkPrerequisite.checkModule('scipy')
+
+    # Check the necessary software
+    if inputGene:
+        ReRCoP_checkPrerequisite.checkCommand('which makeblastdb')
+        ReRCoP_checkPrerequisite.checkCommand('which blastn')
+
+    # Check input files and duplicate names in the fasta files
+    ReRCoP_checkPrerequisite.checkFile(inputGenome)
+    if update:
+        ReRCoP_checkPrerequisite.checkFile(update)
+    genomeIndex = None
+    if aligned:
+        try:
+            genomeIndex = ReRCoP_preprocessing.faidx(inputGenome)
+        except IOError:
+            pass                    # Not indexable, read into memory below
+    if genomeIndex is not None:
+        ReRCoP_checkPrerequisite.checkName(inputGenome, [item[0] for item in genomeIndex])
+    else:
+        ReRCoP_checkPrerequisite.checkName(inputGenome)
+    if inputGbk:
+        ReRCoP_checkPrerequisite.checkFile(inputGbk)
+    if inputGene:
+        ReRCoP_checkPrerequisite.checkFile(inputGene)
+        ReRCoP_checkPrerequisite.checkName(inputGene)
+
+    # Check the output directory
+    ReRCoP_checkPrerequisite.checkDir(outdir)
+
+
+    #################################################################
+    ##### Form concatenate core genome and generate concatenation log
+    #################################################################
+    profile.stage('read')
+
+    # Resume from the core alignment of an earlier run with the same inputs.
+    # The sliding windows are taken from the input alignment itself.
+    core = None
+    if checkpoint:
+        coreKey = ReRCoP_checkpoint.fingerprint([inputGenome, inputGbk, inputGene], dict((key, config[key]) for key in ['aligned', 'window', 'fSize', 'sSize', 'cov', 'sim', 'combined']))
+        if not config['window']:
+            core = ReRCoP_checkpoint.loadCore(checkpoint, coreKey)
+
+    if core is not None:
+        print "Resuming from the core alignment in '%s'" % checkpoint
+    elif aligned and genomeIndex is not None:
+        inGenome = ReRCoP_preprocessing.readMapped(inputGenome, genomeIndex)
+    elif aligned:
+        inGenome = ReRCoP_preprocessing.readAlignment(inputGenome)
+    else:
+        inGenome = ReRCoP_preprocessing.readFasta(inputGenome)
+    if core is None:
+        if aligned:
+            ReRCoP_checkPrerequisite.checkLen(inGenome)
+        profile.count('input genomes', len(inGenome))
+
+    profile.stage('core')
+    if core is not None:
+        [seqConcat, logConcat, regions] = core
+    else:
+        [seqConcat, logConcat, regions] = coreGenome(inGenome, config, profile)
+        if checkpoint and not config['window']:
+            ReRCoP_checkpoint.saveCore(checkpoint, coreKey, seqConcat, logConcat, regions)
+
+    # Input: sequence alignment of new genomes, added to a saved run
+    if update:
+        state = ReRCoP_state.loadState(update)
+        seqConcat = ReRCoP_state.update(state, inGenome, outdir+'/'+prefix+".core"+fastaExt, compress, threads)
+        [logConcat, regions, counts, diff] = [state['log'], state['regions'], state['counts'], state['diff']]
+    profile.count('genomes', len(seqConcat))
+    profile.count('regions', len(logConcat))
+
+
+    ################################################################
+    ##### Generate matrix of SNP number for each gene
+    ################################################################
+    profile.stage('diff')
+    resumed = None
+    if checkpoint:
+        diffKey = ReRCoP_checkpoint.fingerprint([], {}, coreKey)
+        resumed = ReRCoP_checkpoint.loadDiff(checkpoint, diffKey, saveState)
+    if resumed is not None:
+        print "Resuming from the number of SNPs in '%s'" % checkpoint
+        [diff, counts] = resumed
+    elif not update:
+        [diff, counts] = countDiff(seqConcat, logConcat, config, profile)
+        if checkpoint:
+            ReRCoP_checkpoint.saveDiff(checkpoint, diffKey, diff, counts)
+    SNPmat = ReRCoP_matrix.scaleDiff(logConcat, seqConcat.names, diff)
+
+    ################################################################
+    ##### Outlier detection
+    ################################################################
+    if config['sweep']:
+        # Every combination of the parameter grid on the same SNP matrix
+        profile.stage('sweep')
+        SNParr = ReRCoP_matrix.snpArray(SNPmat)
+        methods = [item for item in ["Grubbs", "kNN", "DBSCAN"] if item in outlierMethod]
+        combos = ReRCoP_sweep.combinations(methods, ReRCoP_sweep.parseGrid(config['sweep']), config)
+        selected = []
+        if config['sweepWrite']:
+            selected = [int(item) for item in config['sweepWrite'].split(',')]
+        [starts, ends] = ReRCoP_matrix.regionBounds(logConcat)
+        results = ReRCoP_sweep.sweep(SNParr, combos, starts, ends, config['iterative'], threads)
+        ReRCoP_sweep.writeSummary(outdir+'/'+prefix+".sweep.tsv", combos, results, SNPmat[0][3:], seqConcat.length)
+        profile.count('sweep combinations', len(combos))
+
+        profile.stage('removal')
+        Outliermats = [ReRCoP_matrix.methodMat(SNPmat, ReRCoP_sweep.outlierMask(SNParr, combos[i-1][0], combos[i-1][1], config['iterative'])) for i in selected]
+        ReRCoP_postprocessing.writeMaskedAll(seqConcat, Outliermats, [outdir+'/'+prefix+".sweep%d.%s.removal%s" % (i, combos[i-1][0], fastaExt) for i in selected], compress, threads, profile)
+    else:
+        profile.stage('outliers')
+        [methods, masks] = detectOutliers(SNPmat, config, profile)
+
+        profile.stage('removal')
+        Outliermats = []
+        for item in methods:
+            Outliermats.append(ReRCoP_matrix.methodMat(SNPmat, masks[item]))
+            if matFormat == 'npz':
+                ReRCoP_postprocessing.writeMatNpz(Outliermats[-1], outdir+'/'+prefix+"."+item+".outliermat.npz", True)
+            else:
+                ReRCoP_postprocessing.writeMat(Outliermats[-1], outdir+'/'+prefix+"."+item+".outliermat")
+        ReRCoP_postprocessing.writeMaskedAll(seqConcat, Outliermats, [outdir+'/'+prefix+"."+item+".removal"+fastaExt for item in methods], compress, threads, profile)
+
+
+    ################################################################
+    ##### Write to output
+    ################################################################
+    profile.stage('write')
+
+    ## write the SNP mat
+    if matFormat == 'npz':
+        ReRCoP_postprocessing.writeMatNpz(SNPmat, outdir+'/'+prefix+".snpmat.npz")
+    else:
+        ReRCoP_postprocessing.writeMat(SNPmat, outdir+'/'+prefix+".snpmat")
+
+    ## write the Concatinated sequences
+    if not update:
+        ReRCoP_postprocessing.writeFasta(seqConcat, outdir+'/'+prefix+".core"+fastaExt, compress, threads, profile)
+
+    ## write the log file
+    ReRCoP_postprocessing.writeMat(logConcat, outdir+'/'+prefix+".concatenation.log")
+
+    ## write the state of the run
+    if saveState:
+        ReRCoP_state.saveState(outdir+'/'+prefix+".state.npz", seqConcat.names, logConcat, regions, counts, diff, outdir+'/'+prefix+".core"+fastaExt)
+
+    ## write the run report
+    if profiling:
+        profile.write(outdir+'/'+prefix+".run.json")
+
+
+if __name__ == '__main__':
+    main()
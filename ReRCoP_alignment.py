@@ -0,0 +1,289 @@
+import os
+import mmap
+import numpy
+
+
+class Alignment(object):
+    '''
+    This class holds a set of aligned sequences as a 2-D uint8 array with one
+    row per genome and one column per alignment position, together with the
+    genome names in row order.
+
+    An Alignment can also be used as a read-only fasta object: iterating over
+    it gives the names and indexing it by name gives the sequence as a string.
+    '''
+
+    def __init__(self, names, seqs):
+        '''
+        @param names: a list of sequence names in row order
+        @param seqs: a 2-D uint8 array of shape (len(names), alignment length)
+        '''
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.seqs = seqs
+
+    @property
+    def length(self):
+        '''
+        The number of alignment columns.
+        '''
+        return self.seqs.shape[1]
+
+    def row(self, i):
+        '''
+        This function returns the i-th sequence as a uint8 array.
+
+        @param i: the row index
+        @return a 1-D uint8 array
+        '''
+        return self.seqs[i]
+
+    def columns(self, start, end):
+        '''
+        This function returns the alignment columns [start, end) of all the
+        sequences as a 2-D uint8 array.
+
+        @param start: 0-based start column
+        @param end: 0-based end column, exclusive
+        @return a 2-D uint8 array
+        '''
+        return self.seqs[:, start:end]
+
+    def copy(self):
+        '''
+        This function returns an in-memory copy of the alignment.
+
+        @return an Alignment
+        '''
+        return Alignment(self.names, self.seqs.copy())
+
+    def keys(self):
+        return self.names[:]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.row(self.index[name]).tostring()
+
+
+class MappedAlignment(Alignment):
+    '''
+    This class serves the sequences of an aligned fasta file through a
+    read-only memory map, using a fasta index (see ReRCoP_preprocessing.faidx)
+    to locate each sequence. Only the pages of the file that are accessed are
+    read from disk.
+    '''
+
+    def __init__(self, infile, index):
+        '''
+        @param infile: the fasta file
+        @param index: the fasta index of infile, a list of [name, length,
+        offset, line bases, line width]. It must end where the sequences of
+        the file end.
+        '''
+        self.names = [item[0] for item in index]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.offsets = [item[2] for item in index]
+        self.lineBases = [item[3] for item in index]
+        self.lineWidths = [item[4] for item in index]
+        self._length = index[0][1] if len(index) > 0 else 0
+        for item in index:
+            if item[1] != self._length:
+                raise IOError("Different fasta sequence lengths! Please check!")
+        inH = open(infile, 'rb')
+        if not indexMatches(index, inH):
+            inH.close()
+            raise IOError("The fasta index does not match '%s'!" % infile)
+        if self._length > 0:
+            self._map = mmap.mmap(inH.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = numpy.frombuffer(self._map, dtype=numpy.uint8)
+        else:
+            self._data = numpy.zeros(0, dtype=numpy.uint8)
+        inH.close()
+
+    @property
+    def length(self):
+        '''
+        The number of alignment columns.
+        '''
+        return self._length
+
+    def _slice(self, i, start, end):
+        '''
+        This function returns the columns [start, end) of the i-th sequence,
+        as a view into the memory map whenever the columns lie on one line.
+        '''
+        if end <= start:
+            return self._data[0:0]
+        offset = self.offsets[i]
+        lineBases = self.lineBases[i]
+        if start // lineBases == (end - 1) // lineBases:
+            begin = offset + start // lineBases * self.lineWidths[i] + start % lineBases
+            return self._data[begin:begin + end - start]
+        pos = numpy.arange(start, end)
+        return self._data[offset + pos // lineBases * self.lineWidths[i] + pos % lineBases]
+
+    def row(self, i):
+        return self._slice(i, 0, self._length)
+
+    def columns(self, start, end):
+        start = max(0, min(start, self._length))
+        end = max(start, min(end, self._length))
+        block = numpy.empty((len(self.names), end - start), dtype=numpy.uint8)
+        if end > start:
+            for i in xrange(len(self.names)):
+                block[i] = self._slice(i, start, end)
+        return block
+
+    def copy(self):
+        seqs = numpy.empty((len(self.names), self._length), dtype=numpy.uint8)
+        for i in xrange(len(self.names)):
+            seqs[i] = self.row(i)
+        return Alignment(self.names, seqs)
+
+
+def indexMatches(index, inH):
+    '''
+    This function checks that the last sequence of a fasta index ends where
+    the sequences of the file end, i.e. that only line breaks and blank lines
+    follow it. An index of another version of the file would most likely not.
+
+    @param index: a fasta index, a list of [name, length, offset, line bases,
+    line width]
+    @param inH: the fasta file opened in binary mode
+    @return True if the index ends where the sequences end
+    '''
+    size = os.fstat(inH.fileno()).st_size
+    if len(index) == 0:
+        end = 0
+    else:
+        [_, length, offset, lineBases, lineWidth] = index[-1]
+        end = offset
+        if length > 0:
+            if lineBases <= 0:
+                return False
+            lines = (length + lineBases - 1) // lineBases
+            end = offset + (lines - 1) * lineWidth + length - (lines - 1) * lineBases
+    if size < end:
+        return False
+    inH.seek(end)
+    while True:
+        chunk = inH.read(1<<16)
+        if not chunk:
+            return True
+        if chunk.strip():
+            return False
+
+
+def toAlignment(inFasta):
+    '''
+    This function converts a fasta object into an Alignment. An Alignment is
+    returned as it is.
+
+    @param inFasta: a fasta object (dictionary) of sequences of equal length,
+    or an Alignment
+    @return an Alignment
+    '''
+    if isinstance(inFasta, Alignment):
+        return inFasta
+    names = list(inFasta)
+    if len(names) == 0:
+        return Alignment([], numpy.zeros((0, 0), dtype=numpy.uint8))
+    length = len(inFasta[names[0]])
+    for name in names:
+        if len(inFasta[name]) != length:
+            raise IOError("Different fasta sequence lengths! Please check!")
+    seqs = numpy.frombuffer("".join(inFasta[name] for name in names), dtype=numpy.uint8)
+    return Alignment(names, seqs.reshape(len(names), length).copy())
+
+
+def encodeSeq(seq):
+    '''
+    This function converts a sequence string into a uint8 array.
+
+    @param seq: a sequence string or a uint8 array
+    @return a 1-D uint8 array
+    '''
+    if isinstance(seq, numpy.ndarray):
+        return seq
+    return numpy.frombuffer(seq, dtype=numpy.uint8)
+
+
+class BaseCounts(object):
+    '''
+    This class holds the per-column character counts of an alignment: the
+    characters seen so far as a sorted uint8 array, and a 2-D count table of
+    shape (alignment length, number of characters).
+    '''
+
+    def __init__(self, length):
+        '''
+        @param length: the alignment length
+        '''
+        self.alphabet = numpy.zeros(0, dtype=numpy.uint8)
+        self.counts = numpy.zeros((length, 0), dtype=numpy.uint32)
+
+    def extend(self, symbols):
+        '''
+        This function adds new characters to the alphabet, inserting columns
+        of zeros in the count table.
+
+        @param symbols: a uint8 array of characters
+        '''
+        new = numpy.setdiff1d(symbols, self.alphabet)
+        if len(new) == 0:
+            return
+        alphabet = numpy.union1d(self.alphabet, new).astype(numpy.uint8)
+        counts = numpy.zeros((self.counts.shape[0], len(alphabet)), dtype=numpy.uint32)
+        counts[:, numpy.searchsorted(alphabet, self.alphabet)] = self.counts
+        self.alphabet = alphabet
+        self.counts = counts
+
+    def add(self, block, start=0):
+        '''
+        This function counts the characters of a block of aligned sequences
+        into the columns [start, start+block width) with a single bincount.
+
+        @param block: a 2-D uint8 array with one row per sequence
+        @param start: 0-based alignment column of the first block column
+        '''
+        width = block.shape[1]
+        if width == 0 or block.shape[0] == 0:
+            return
+        self.extend(numpy.flatnonzero(numpy.bincount(block.ravel(), minlength=256)))
+        nSym = len(self.alphabet)
+        code = numpy.zeros(256, dtype=numpy.intp)
+        code[self.alphabet] = numpy.arange(nSym)
+        flat = code[block] + numpy.arange(0, width*nSym, nSym)
+        count = numpy.bincount(flat.ravel(), minlength=width*nSym).reshape(width, nSym)
+        self.counts[start:start+width] += count.astype(numpy.uint32)
+
+    def consensus(self):
+        '''
+        This function returns the most frequent character of each column. Ties
+        are broken in favour of the smallest character code.
+
+        @return a 1-D uint8 array
+        '''
+        if len(self.alphabet) == 0:
+            return numpy.zeros(self.counts.shape[0], dtype=numpy.uint8)
+        return self.alphabet[self.counts.argmax(axis=1)]
+
+
+def blockWidth(nSeq, cells=1<<23):
+    '''
+    This function returns a number of columns such that a block of nSeq
+    sequences holds about the given number of cells.
+
+    @param nSeq: the number of sequences
+    @param cells: the target number of cells per block
+    @return an int
+    '''
+    return max(1, cells // max(1, nSeq))
@@ -0,0 +1,330 @@
+import sys
+import time
+import resource
+import numpy
+import ReRCoP_alignment
+import ReRCoP_checkPrerequisite
+import ReRCoP_matrix
+import ReRCoP_outlierDetection
+import ReRCoP_postprocessing
+import ReRCoP_preprocessing
+from optparse import OptionParser
+
+
+# The characters of the synthetic genomes
+NUCLEOTIDES = numpy.array([ord(c) for c in 'ACGT'], dtype=numpy.uint8)
+
+
+def mutate(seq, rate, random):
+    '''
+    This function substitutes a random fraction of the positions of a
+    sequence, each with one of the three other nucleotides.
+
+    @param seq: a 1-D uint8 array of nucleotides
+    @param rate: the fraction of positions to substitute
+    @param random: a numpy.random.RandomState
+    @return a mutated copy of seq
+    '''
+    seq = seq.copy()
+    pos = numpy.flatnonzero(random.random_sample(len(seq)) < rate)
+    code = numpy.searchsorted(NUCLEOTIDES, seq[pos])
+    seq[pos] = NUCLEOTIDES[(code + random.randint(1, 4, len(pos))) % 4]
+    return seq
+
+
+def syntheticGenes(length, random, minLen=300, maxLen=1500, minGap=50, maxGap=300):
+    '''
+    This function lays out genes along a genome, separated by intergenic
+    regions.
+
+    @param length: the genome length
+    @param random: a numpy.random.RandomState
+    @return a list of list [[gene.name, gene.start, gene.end], ...] with
+    1-based inclusive positions, as returned by ReRCoP_preprocessing.readGbk
+    '''
+    output = []
+    current = random.randint(minGap, maxGap+1)
+    while True:
+        geneLen = random.randint(minLen, maxLen+1) // 3 * 3
+        if current + geneLen > length:
+            break
+        output.append(["gene%05d" % (len(output)+1), current+1, current+geneLen])
+        current += geneLen + random.randint(minGap, maxGap+1)
+    return output
+
+
+def syntheticAlignment(nGenome, length, rate, divergence=0.01, donor=0.1, seed=1):
+    '''
+    This function generates aligned genomes that descend from a common
+    ancestor, and plants recombinant genes: with probability rate, a gene of
+    a genome is replaced by the same gene of a divergent donor lineage.
+
+    @param nGenome: the number of genomes
+    @param length: the genome length
+    @param rate: the probability of each gene of each genome to be recombinant
+    @param divergence: the fraction of positions mutated in each genome
+    @param donor: the fraction of positions mutated in the donor lineage
+    @param seed: the seed of the random number generator
+    @return [Alignment, genes, ancestor, planted] with genes as returned by
+    'syntheticGenes', ancestor a 1-D uint8 array and planted a list of list
+    [[genome index, gene index], ...]
+    '''
+    random = numpy.random.RandomState(seed)
+    ancestor = NUCLEOTIDES[random.randint(0, 4, length)]
+    genes = syntheticGenes(length, random)
+    donorSeq = mutate(ancestor, donor, random)
+    seqs = numpy.empty((nGenome, length), dtype=numpy.uint8)
+    planted = []
+    for i in xrange(nGenome):
+        seqs[i] = mutate(ancestor, divergence, random)
+        for j in numpy.flatnonzero(random.random_sample(len(genes)) < rate):
+            [start, end] = [genes[j][1]-1, genes[j][2]]
+            seqs[i, start:end] = mutate(donorSeq[start:end], divergence, random)
+            planted.append([i, j])
+    names = ["genome%04d" % (i+1) for i in xrange(nGenome)]
+    return [ReRCoP_alignment.Alignment(names, seqs), genes, ancestor, planted]
+
+
+def writeGbk(genes, length, outfile):
+    '''
+    This function writes the genes as the CDS features of a GenBank file.
+
+    @param genes: a list of list [[gene.name, gene.start, gene.end], ...]
+    @param length: the genome length
+    @param outfile: output GenBank file
+    '''
+    outH = open(outfile, 'w')
+    outH.write("LOCUS       synthetic %d bp    DNA     linear\n" % length)
+    outH.write("FEATURES             Location/Qualifiers\n")
+    for [name, start, end] in genes:
+        outH.write("     CDS             %d..%d\n" % (start, end))
+        outH.write("                     /locus_tag=\"%s\"\n" % name)
+    outH.write("//\n")
+    outH.close()
+
+
+def writeCds(genes, ancestor, outfile):
+    '''
+    This function writes the ancestral sequence of each gene in fasta format.
+
+    @param genes: a list of list [[gene.name, gene.start, gene.end], ...]
+    @param ancestor: a 1-D uint8 array of the ancestral genome
+    @param outfile: output fasta file
+    '''
+    outH = open(outfile, 'w')
+    for [name, start, end] in genes:
+        outH.write(">%s\n" % name)
+        outH.write("%s\n" % ancestor[start-1:end].tostring())
+    outH.close()
+
+
+def peakMemory():
+    '''
+    This function returns the peak resident memory of the process so far.
+
+    @return the peak memory in MB
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer(object):
+    '''
+    This class runs the stages of a benchmark and records the wall-clock time
+    of each stage and the peak memory of the process at its end.
+    '''
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, func, *args):
+        '''
+        This function calls func with the given arguments as a timed stage.
+
+        @param name: the stage name
+        @param func: the function to call
+        @return the return value of func
+        '''
+        start = time.time()
+        result = func(*args)
+        self.stages.append([name, time.time() - start, peakMemory()])
+        return result
+
+
+def regionSpans(log, genes, mode):
+    '''
+    This function returns the alignment positions of the regions of a
+    concatenation log.
+
+    @param log: the concatenation log
+    @param genes: the genes of the synthetic genomes
+    @param mode: 'window' if the log regions are sliding windows, else genes
+    @return [starts, ends] as int64 arrays of 1-based inclusive positions
+    '''
+    if mode == 'window':
+        return [numpy.array([item[1] for item in log], dtype=numpy.int64),
+                numpy.array([item[2] for item in log], dtype=numpy.int64)]
+    position = dict((gene[0], gene[1:]) for gene in genes)
+    spans = numpy.array([position[item[0]] for item in log], dtype=numpy.int64).reshape(-1, 2)
+    return [spans[:, 0], spans[:, 1]]
+
+
+def recall(mask, names, spans, genes, planted):
+    '''
+    This function compares the outliers found with the planted recombinant
+    genes. A planted gene is recalled if a region overlapping it is an
+    outlier in its genome, and an outlier is false if its region overlaps no
+    planted gene of its genome.
+
+    @param mask: a 2-D boolean array of outliers, one row per region and one
+    column per genome
+    @param names: the genome names in the column order of mask, as indices
+    into the synthetic genomes
+    @param spans: the region positions returned by 'regionSpans'
+    @param genes: the genes of the synthetic genomes
+    @param planted: the planted recombinant genes
+    @return [planted genes, recalled genes, outliers, false outliers]
+    '''
+    [starts, ends] = spans
+    column = dict((int(name[6:])-1, i) for i, name in enumerate(names))
+    recombinant = numpy.zeros(mask.shape, dtype=bool)
+    # The regions are in genome order, so the regions overlapping a gene
+    # are a range of rows
+    ordered = (numpy.diff(starts) >= 0).all() and (numpy.diff(ends) >= 0).all()
+    nRecalled = 0
+    for [genome, gene] in planted:
+        if genome not in column:
+            continue
+        if ordered:
+            overlap = slice(numpy.searchsorted(ends, genes[gene][1]), numpy.searchsorted(starts, genes[gene][2], 'right'))
+        else:
+            overlap = (starts <= genes[gene][2]) & (ends >= genes[gene][1])
+        recombinant[overlap, column[genome]] = True
+        if mask[overlap, column[genome]].any():
+            nRecalled += 1
+    return [len(planted), nRecalled, int(mask.sum()), int((mask & ~recombinant).sum())]
+
+
+def benchmark(mode, outdir, prefix, alignFile, gbkFile, cdsFile, genes, planted, options):
+    '''
+    This function runs the stages of the ReRCoP pipeline on the synthetic
+    genomes in one mode.
+
+    @param mode: 'gbk', 'window' or 'raw'
+    @param outdir: output directory
+    @param prefix: output prefix
+    @param alignFile: the fasta file of the synthetic genomes
+    @param gbkFile: the GenBank file of the genes
+    @param cdsFile: the fasta file of the gene sequences
+    @param genes: the genes of the synthetic genomes
+    @param planted: the planted recombinant genes
+    @param options: the parsed command line options
+    @return [stages, recall] with stages a list of list [[name, seconds, peak
+    memory in MB], ...] and recall a list of list [[method, planted,
+    recalled, outliers, false outliers], ...]
+    '''
+    timer = StageTimer()
+    base = outdir + '/' + prefix + '.' + mode
+    if mode == 'raw':
+        inGenome = timer.run('readFasta', ReRCoP_preprocessing.readFasta, alignFile)
+        inGene = timer.run('readFasta (cds)', ReRCoP_preprocessing.readFasta, cdsFile)
+        tmpFile = base + ".ReRCoP.tmp"
+        [seqConcat, logConcat] = timer.run('parseRaw', ReRCoP_preprocessing.parseRaw, inGene, inGenome, options.sim, options.cov, tmpFile+".1", tmpFile+".2", tmpFile+".3", options.threads)
+        seqConcat = ReRCoP_alignment.toAlignment(seqConcat)
+    else:
+        inGenome = timer.run('readAlignment', ReRCoP_preprocessing.readAlignment, alignFile)
+        if mode == 'gbk':
+            inGbk = timer.run('readGbk', ReRCoP_preprocessing.readGbk, gbkFile)
+            [seqConcat, logConcat] = timer.run('parseGbk', ReRCoP_preprocessing.parseGbk, inGbk, inGenome, options.cov)
+        else:
+            fullLen = ReRCoP_preprocessing.fastaLen(inGenome)
+            logConcat = timer.run('slidingWindow', ReRCoP_preprocessing.slidingWindow, fullLen, options.fSize, options.sSize)
+            seqConcat = inGenome
+
+    SNPmat = timer.run('GeneDiff', ReRCoP_matrix.GeneDiff, logConcat, seqConcat)
+    SNParr = ReRCoP_matrix.snpArray(SNPmat)
+    methods = ['Grubbs', 'kNN', 'DBSCAN']
+    timer.run('GrubbsMat', ReRCoP_outlierDetection.GrubbsMat, SNParr, options.alpha)
+    timer.run('kNNMat', ReRCoP_outlierDetection.kNNMat, SNParr, options.k, options.radius)
+    timer.run('DBSCANMat', ReRCoP_outlierDetection.DBSCANMat, SNParr, options.eps, options.minP)
+    masks = timer.run('outlierMats', ReRCoP_outlierDetection.outlierMats, SNParr, methods, options.alpha, False, options.k, options.radius, options.eps, options.minP)
+
+    Outliermats = [ReRCoP_matrix.methodMat(SNPmat, masks[item]) for item in methods]
+    timer.run('writeMaskedAll', ReRCoP_postprocessing.writeMaskedAll, seqConcat, Outliermats, [base+"."+item+".removal.fasta" for item in methods])
+    timer.run('writeFasta', ReRCoP_postprocessing.writeFasta, seqConcat, base+".core.fasta")
+    timer.run('writeMat', ReRCoP_postprocessing.writeMat, SNPmat, base+".snpmat")
+
+    spans = regionSpans(logConcat, genes, mode)
+    output = []
+    for item in methods:
+        output.append([item] + recall(masks[item], SNPmat[0][3:], spans, genes, planted))
+    return [timer.stages, output]
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage, version="%prog 1.0")
+    parser.add_option("--genomes",action="store",type="int",dest="genomes",default=20,help="Number of synthetic genomes. [Default: 20]")
+    parser.add_option("--length",action="store",type="int",dest="length",default=200000,help="Length of the synthetic genomes. [Default: 200000]")
+    parser.add_option("--rate",action="store",type="float",dest="rate",default=0.02,help="Probability of each gene of each genome to be recombinant. [Default: 0.02]")
+    parser.add_option("--divergence",action="store",type="float",dest="divergence",default=0.01,help="Fraction of the positions mutated in each genome. [Default: 0.01]")
+    parser.add_option("--donor",action="store",type="float",dest="donor",default=0.1,help="Fraction of the positions mutated in the donor lineage of the recombinant genes. [Default: 0.1]")
+    parser.add_option("--seed",action="store",type="int",dest="seed",default=1,help="Seed of the random number generator. [Default: 1]")
+    parser.add_option("--mode",action="store",type="string",dest="mode",default="gbk,window",help="Pipeline modes to run, 'gbk', 'window' or 'raw' (needs BLAST), separated by ','. [Default: gbk,window]")
+    parser.add_option("--fSize",action="store",type="int",dest="fSize",default=1000,help="Fragment size of the 'window' mode. [Default: 1000]")
+    parser.add_option("--sSize",action="store",type="int",dest="sSize",default=500,help="Step size of the 'window' mode. [Default: 500]")
+    parser.add_option("--cov",action="store",type="float",dest="cov",default=0.7,help="Minimum sequence coverage to regard genes as present. [Default: 0.7]")
+    parser.add_option("--sim",action="store",type="float",dest="sim",default=70,help="Minimum sequence similarity to regard genes as present. [Default: 70]")
+    parser.add_option("--threads",action="store",type="int",dest="threads",default=1,help="Number of BLAST searches to run at the same time in the 'raw' mode. [Default: 1]")
+    parser.add_option("--alpha",action="store",type="float",dest="alpha",default=0.05,help="Significance level of the Grubbs test. [Default: 0.05]")
+    parser.add_option("--radius",action="store",type="float",dest="radius",default=1.5,help="Neighbor radius of the kNN method. [Default: 1.5]")
+    parser.add_option("--k",action="store",type="float",dest="k",default=0.2,help="Minimum number of neighbors of the kNN method. [Default: 0.2]")
+    parser.add_option("--eps",action="store",type="float",dest="eps",default=1,help="Neighborhood radius of the DBSCAN method. [Default: 1]")
+    parser.add_option("--minP",action="store",type="float",dest="minP",default=0.2,help="Minimum number of points of a dense region of the DBSCAN method. [Default: 0.2]")
+    parser.add_option("-o", "--outdir",action="store",type="string",dest="outdir",default=".",help="Output directory. [Default: running directory]")
+    parser.add_option("-p", "--prefix",action="store",type="string",dest="prefix",default="benchmark",help="Output prefix. [Default: benchmark]")
+    (options, args) = parser.parse_args()
+
+    modes = options.mode.split(',')
+    for item in modes:
+        if item not in ['gbk', 'window', 'raw']:
+            parser.error("Option --mode should be 'gbk', 'window', or 'raw'")
+    if options.genomes < 3:
+        parser.error("Option --genomes should be no less than 3.")
+    if options.rate < 0 or options.rate > 1:
+        parser.error("Option --rate should be within the range of 0-1.")
+    if options.sSize <= 0 or options.sSize > options.fSize:
+        parser.error("Option --sSize should be larger than 0 and no larger than --fSize")
+    if 'raw' in modes:
+        ReRCoP_checkPrerequisite.checkCommand('which makeblastdb')
+        ReRCoP_checkPrerequisite.checkCommand('which blastn')
+    ReRCoP_checkPrerequisite.checkDir(options.outdir)
+
+    base = options.outdir + '/' + options.prefix
+    start = time.time()
+    [aln, genes, ancestor, planted] = syntheticAlignment(options.genomes, options.length, options.rate, options.divergence, options.donor, options.seed)
+    ReRCoP_postprocessing.writeFasta(aln, base + ".fasta")
+    writeGbk(genes, options.length, base + ".gbk")
+    writeCds(genes, ancestor, base + ".cds.fasta")
+    print "Generated %d genomes of %d bp with %d genes and %d recombinant genes in %.2f s" % (options.genomes, options.length, len(genes), len(planted), time.time() - start)
+    del aln
+
+    stageH = open(base + ".stages.tsv", 'w')
+    stageH.write("Mode\tStage\tSeconds\tPeakMB\n")
+    recallH = open(base + ".recall.tsv", 'w')
+    recallH.write("Mode\tMethod\tPlanted\tRecalled\tRecall\tOutliers\tFalse\n")
+    for mode in modes:
+        [stages, result] = benchmark(mode, options.outdir, options.prefix, base + ".fasta", base + ".gbk", base + ".cds.fasta", genes, planted, options)
+        for [name, seconds, memory] in stages:
+            print "%s\t%-16s %8.3f s %8.1f MB" % (mode, name, seconds, memory)
+            stageH.write("%s\t%s\t%.6f\t%.1f\n" % (mode, name, seconds, memory))
+        for [method, nPlanted, nRecalled, nOutlier, nFalse] in result:
+            share = float(nRecalled) / nPlanted if nPlanted > 0 else 1.0
+            print "%s\t%-16s recall %d/%d (%.3f), %d outliers, %d false" % (mode, method, nRecalled, nPlanted, share, nOutlier, nFalse)
+            recallH.write("%s\t%s\t%d\t%d\t%.6f\t%d\t%d\n" % (mode, method, nPlanted, nRecalled, share, nOutlier, nFalse))
+        sys.stdout.flush()
+    stageH.close()
+    recallH.close()
+
+
+if __name__ == '__main__':
+    main()
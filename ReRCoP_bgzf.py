@@ -0,0 +1,158 @@
+import zlib
+import gzip
+import struct
+import numpy
+from multiprocessing.pool import ThreadPool
+
+
+# Maximum number of uncompressed bytes in a BGZF block, as used by htslib
+BLOCK = 0xff00
+
+# The empty block marking the end of a BGZF file
+EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def isGzip(infile):
+    '''
+    This function checks whether a file is gzip compressed, which includes
+    the BGZF format.
+
+    @param infile: input file
+    @return a boolean value
+    '''
+    inH = open(infile, 'rb')
+    magic = inH.read(2)
+    inH.close()
+    return magic == "\x1f\x8b"
+
+
+def openInput(infile):
+    '''
+    This function opens a plain or gzip compressed file for reading.
+
+    @param infile: input file
+    @return a file object
+    '''
+    if isGzip(infile):
+        return gzip.open(infile, 'rb')
+    return open(infile, 'rb')
+
+
+def readAll(infile):
+    '''
+    This function returns the content of a plain or gzip compressed file,
+    decompressing all the gzip members of the file (e.g. BGZF blocks).
+
+    @param infile: input file
+    @return a string
+    '''
+    inH = open(infile, 'rb')
+    data = inH.read()
+    inH.close()
+    if data[:2] != "\x1f\x8b":
+        return data
+    output = []
+    pos = 0
+    while pos < len(data):
+        # Feed each member in chunks, so that the data after the end of a
+        # member is never copied in full
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while pos < len(data):
+            chunk = buffer(data, pos, 1<<16)
+            output.append(decompressor.decompress(chunk))
+            pos += len(chunk) - len(decompressor.unused_data)
+            if len(decompressor.unused_data) > 0:
+                break
+        output.append(decompressor.flush())
+    return "".join(output)
+
+
+def compressBlock(data, level=6):
+    '''
+    This function compresses up to BLOCK bytes into one BGZF block.
+
+    @param data: the uncompressed string
+    @param level: the zlib compression level
+    @return the BGZF block as a string
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(payload) + 25)
+    return header + payload + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    '''
+    This class writes a BGZF file, the blocked gzip format read by gzip and
+    samtools. Written data is buffered and compressed in batches of blocks,
+    the blocks of a batch being compressed at the same time by a pool of
+    threads.
+    '''
+
+    def __init__(self, outfile, threads=1, level=6, append=False):
+        '''
+        @param outfile: output file
+        @param threads: the number of compressing threads
+        @param level: the zlib compression level
+        @param append: append the blocks to an existing BGZF file
+        '''
+        self.handle = open(outfile, 'ab' if append else 'wb')
+        self.level = level
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.batch = BLOCK * 8 * threads
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        '''
+        This function writes a string or a uint8 array.
+        '''
+        if isinstance(data, numpy.ndarray):
+            data = data.tostring()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.batch:
+            self.flush()
+
+    def flush(self, final=False):
+        '''
+        This function compresses and writes the buffered data in whole
+        blocks, or all of it if final.
+        '''
+        data = "".join(self.buffer)
+        end = len(data) if final else len(data) // BLOCK * BLOCK
+        blocks = [data[i:i+BLOCK] for i in xrange(0, end, BLOCK)]
+        compress = lambda block: compressBlock(block, self.level)
+        if self.pool is not None:
+            self.handle.write("".join(self.pool.map(compress, blocks)))
+        else:
+            self.handle.write("".join(map(compress, blocks)))
+        self.buffer = [data[end:]]
+        self.size = len(data) - end
+
+    def close(self):
+        '''
+        This function writes the remaining data and the end of file marker.
+        '''
+        self.flush(True)
+        self.handle.write(EOF)
+        self.handle.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def openOutput(outfile, compress=False, threads=1, append=False):
+    '''
+    This function opens an output file with a large write buffer, as a
+    BgzfWriter if compress.
+
+    @param outfile: output file
+    @param compress: write the file in BGZF format
+    @param threads: the number of compressing threads
+    @param append: append to the file
+    @return a file object or BgzfWriter
+    '''
+    if compress:
+        return BgzfWriter(outfile, threads, append=append)
+    return open(outfile, 'ab' if append else 'wb', 1<<20)
@@ -0,0 +1,379 @@
+import os
+import glob
+import shutil
+import hashlib
+import subprocess
+
+
+# Tabular output format of the BLAST searches, as parsed by readHits
+OUTFMT = "6 qseqid qlen sseqid qstart qend sstart send length pident qseq sseq"
+
+
+def writeSeq(inFasta, outfile, names=None):
+    '''
+    This function writes the sequences of a fasta object into a fasta file.
+
+    @param inFasta: a fasta object
+    @param outfile: output fasta file
+    @param names: the names of the sequences to write [Default: all]
+    '''
+    if names is None:
+        names = list(inFasta)
+    outH = open(outfile, 'w')
+    for name in names:
+        outH.write(">%s\n" % name)
+        outH.write("%s\n" % inFasta[name])
+    outH.close()
+
+
+def run(command):
+    '''
+    This function runs a BLAST command and raises an OSError if it fails. An
+    OSError rather than subprocess.CalledProcessError is raised so that the
+    error can be passed back from a worker process.
+
+    @param command: the command line as a list
+    '''
+    try:
+        subprocess.check_call(command)
+    except subprocess.CalledProcessError as e:
+        raise OSError("Command '%s' failed with exit status %d!" % (command[0], e.returncode))
+
+
+def makeDb(infile, db):
+    '''
+    This function builds a nucleotide BLAST database, raising an error if
+    makeblastdb fails.
+
+    @param infile: input fasta file
+    @param db: the database name
+    '''
+    run(["makeblastdb", "-in", infile, "-out", db, "-dbtype", "nucl"])
+
+
+def removeDb(db):
+    '''
+    This function removes the files of a BLAST database.
+
+    @param db: the database name
+    '''
+    for dbFile in glob.glob(db + ".n*"):
+        os.remove(dbFile)
+
+
+def blastCommand(query, db, maxTarget=1, threads=1):
+    '''
+    This function returns the blastn command line searching the query
+    sequences against a BLAST database, with the tabular output on stdout.
+
+    @param query: the query fasta file
+    @param db: the database name
+    @param maxTarget: the number of subjects kept for each query
+    @param threads: the number of threads used by blastn
+    @return a list of command line arguments
+    '''
+    command = ["blastn", "-query", query, "-db", db, "-task", "blastn", "-outfmt", OUTFMT, "-max_target_seqs", str(maxTarget)]
+    if threads > 1:
+        command += ["-num_threads", str(threads)]
+    return command
+
+
+def search(query, db, outfile):
+    '''
+    This function searches the query sequences against a BLAST database and
+    keeps the best subject of each query. If blastn fails, the partial output
+    file is removed and an error is raised.
+
+    @param query: the query fasta file
+    @param db: the database name
+    @param outfile: the tabular output file
+    '''
+    try:
+        run(blastCommand(query, db) + ["-out", outfile])
+    except:
+        if os.path.isfile(outfile):
+            os.remove(outfile)
+        raise
+
+
+def blastCombined(seq, genomes, query, db, hitFiles, threads=1):
+    '''
+    This function builds one BLAST database holding all the genomes, with each
+    sequence ID tagged by the index of its genome, and searches the query
+    sequences against it in a single multi-threaded blastn run. The tabular
+    output is split per genome while it is streamed, with the sequence IDs
+    replaced by the genome names. If blastn fails, the output files are
+    removed and an error is raised.
+
+    @param seq: a fasta object of the genome sequences
+    @param genomes: the genome names in index order
+    @param query: the query fasta file
+    @param db: the database name, also used for its fasta file
+    @param hitFiles: the tabular output file of each genome, in index order
+    @param threads: the number of threads used by blastn
+    '''
+    outH = open(db, 'w')
+    for i in xrange(len(genomes)):
+        outH.write(">%d\n" % i)
+        outH.write("%s\n" % seq[genomes[i]])
+    outH.close()
+
+    handles = []
+    command = blastCommand(query, db, len(genomes), threads)
+    status = None
+    try:
+        makeDb(db, db)
+        handles = [open(hitFile, 'w') for hitFile in hitFiles]
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            for line in proc.stdout:
+                tmp = line.split('\t', 3)
+                i = int(tmp[2].split('|')[-1])
+                tmp[2] = genomes[i]
+                handles[i].write('\t'.join(tmp))
+        except (IndexError, ValueError):
+            # Output that is not a hit table, e.g. from a failing blastn
+            proc.stdout.read()
+            if proc.wait() == 0:
+                raise
+        status = proc.wait()
+    finally:
+        for outH in handles:
+            outH.close()
+        removeDb(db)
+        os.remove(db)
+        if status != 0:
+            for hitFile in hitFiles:
+                if os.path.isfile(hitFile):
+                    os.remove(hitFile)
+    if status != 0:
+        raise OSError("Command '%s' failed with exit status %d!" % (command[0], status))
+
+
+def digest(*parts):
+    '''
+    This function returns the SHA-1 hex digest of a list of strings.
+    '''
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part)
+        sha.update('\0')
+    return sha.hexdigest()
+
+
+def fileDigest(infile):
+    '''
+    This function returns the SHA-1 hex digest of the content of a file.
+    '''
+    sha = hashlib.sha1()
+    inH = open(infile, 'rb')
+    for chunk in iter(lambda: inH.read(1<<20), ''):
+        sha.update(chunk)
+    inH.close()
+    return sha.hexdigest()
+
+
+def renameHits(infile, outfile, name):
+    '''
+    This function copies a tabular BLAST output, setting the subject sequence
+    ID of every hit to the given name.
+    '''
+    inH = open(infile)
+    outH = open(outfile, 'w')
+    for line in inH:
+        tmp = line.split('\t', 3)
+        tmp[2] = name
+        outH.write('\t'.join(tmp))
+    outH.close()
+    inH.close()
+
+
+class BlastCache(object):
+    '''
+    This class keeps BLAST databases and hit tables in a directory so that
+    they can be reused by later runs. A database is keyed by a hash of the
+    genome sequence, and a hit table by a hash of the query sequences, the
+    genome sequence and the search parameters. Entries are touched when used
+    and the least recently used ones are evicted once the cache grows beyond
+    its size limit.
+    '''
+
+    def __init__(self, directory, maxSize):
+        '''
+        @param directory: the cache directory
+        @param maxSize: the size limit of the cache in bytes
+        '''
+        self.directory = directory
+        self.maxSize = maxSize
+        for sub in ['db', 'hits']:
+            path = os.path.join(directory, sub)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise OSError("Cannot create directory: '%s'!" % path)
+
+    def database(self, sequence):
+        '''
+        This function returns the BLAST database of a genome sequence, building
+        it if it is not in the cache.
+
+        @param sequence: the genome sequence
+        @return the database name
+        '''
+        key = digest(sequence)
+        db = os.path.join(self.directory, 'db', key)
+        if not os.path.isfile(db + '.ok'):
+            # Build in a private directory and move into place when complete
+            build = os.path.join(self.directory, 'db', 'build.%d' % os.getpid())
+            if not os.path.isdir(build):
+                os.makedirs(build)
+            try:
+                writeSeq({key:sequence}, os.path.join(build, key))
+                makeDb(os.path.join(build, key), os.path.join(build, key))
+                dbFiles = glob.glob(os.path.join(build, key + '.n*'))
+                if len(dbFiles) == 0:
+                    raise OSError("No BLAST database was built for '%s'!" % key)
+                for dbFile in dbFiles:
+                    os.rename(dbFile, os.path.join(self.directory, 'db', os.path.basename(dbFile)))
+            finally:
+                shutil.rmtree(build)
+            open(db + '.ok', 'w').close()
+        os.utime(db + '.ok', None)
+        return db
+
+    def hitFile(self, query, sequence, tag):
+        '''
+        This function returns the cache file of the hits of the query
+        sequences against a genome sequence.
+
+        @param query: the query fasta file
+        @param sequence: the genome sequence
+        @param tag: a string describing the search parameters
+        @return the file name
+        '''
+        return os.path.join(self.directory, 'hits', digest(fileDigest(query), digest(sequence), OUTFMT, tag))
+
+    def fetch(self, query, sequence, outfile, name, tag='single'):
+        '''
+        This function copies the cached hits of the query sequences against a
+        genome sequence, if any, to a tabular output file.
+
+        @param query: the query fasta file
+        @param sequence: the genome sequence
+        @param outfile: the tabular output file
+        @param name: the genome name written as subject sequence ID
+        @param tag: a string describing the search parameters
+        @return a boolean value of whether the hits were in the cache
+        '''
+        hitFile = self.hitFile(query, sequence, tag)
+        if not os.path.isfile(hitFile):
+            return False
+        os.utime(hitFile, None)
+        renameHits(hitFile, outfile, name)
+        return True
+
+    def store(self, query, sequence, infile, tag='single'):
+        '''
+        This function adds the hits of the query sequences against a genome
+        sequence to the cache.
+
+        @param query: the query fasta file
+        @param sequence: the genome sequence
+        @param infile: the tabular output file of the search
+        @param tag: a string describing the search parameters
+        '''
+        hitFile = self.hitFile(query, sequence, tag)
+        shutil.copyfile(infile, "%s.%d" % (hitFile, os.getpid()))
+        os.rename("%s.%d" % (hitFile, os.getpid()), hitFile)
+
+    def search(self, query, sequence, outfile, name):
+        '''
+        This function searches the query sequences against a genome sequence as
+        'search' does, reusing the cached database and hits when available.
+
+        @param query: the query fasta file
+        @param sequence: the genome sequence
+        @param outfile: the tabular output file
+        @param name: the genome name written as subject sequence ID
+        '''
+        if self.fetch(query, sequence, outfile, name):
+            return
+        search(query, self.database(sequence), outfile)
+        self.store(query, sequence, outfile)
+        self.fetch(query, sequence, outfile, name)
+
+    def evict(self):
+        '''
+        This function removes the least recently used databases and hit tables
+        until the cache fits in its size limit.
+        '''
+        entries = {}
+        for sub in ['db', 'hits']:
+            path = os.path.join(self.directory, sub)
+            for fileName in os.listdir(path):
+                fullName = os.path.join(path, fileName)
+                if not os.path.isfile(fullName):
+                    continue
+                key = (sub, fileName.split('.')[0])
+                if key not in entries:
+                    entries[key] = [0, 0, []]
+                entries[key][0] += os.path.getsize(fullName)
+                entries[key][1] = max(entries[key][1], os.path.getmtime(fullName))
+                entries[key][2].append(fullName)
+
+        total = sum(entry[0] for entry in entries.values())
+        for entry in sorted(entries.values(), key=lambda x:x[1]):
+            if total <= self.maxSize:
+                break
+            for fullName in entry[2]:
+                os.remove(fullName)
+            total -= entry[0]
+
+
+def blastGenome(task):
+    '''
+    This function searches the query sequences against one genome, in its own
+    set of files so that several genomes can be searched at the same time.
+    The database is kept and should be removed with 'removeDb'. If a
+    BlastCache is given, the search goes through the cache and no database
+    is left behind. Either way, the subject sequence ID of the hits is the
+    genome name, which BLAST may have shortened or replaced.
+
+    @param task: [genome name, genome sequence, query fasta file, database
+    name, tabular output file, BlastCache or None]
+    '''
+    [name, sequence, query, db, outfile, cache] = task
+    if cache is not None:
+        cache.search(query, sequence, outfile, name)
+        return
+    writeSeq({name:sequence}, db)
+    makeDb(db, db)
+    search(query, db, outfile + '.raw')
+    renameHits(outfile + '.raw', outfile, name)
+    os.remove(outfile + '.raw')
+
+
+def readHits(infile):
+    '''
+    This function reads in the tabular output of a BLAST search.
+
+    @param infile: the tabular output file
+    @return a list of list [qseqid, qlen, sseqid, qstart, qend, sstart, send,
+    length, pident, qseq, sseq] with qlen, qstart, qend and length as int and
+    pident as float
+    '''
+    output = []
+    inH = open(infile)
+    for line in inH:
+        line = line.strip('\n')
+        tmp = line.split('\t')
+        tmp[1] = int(tmp[1])
+        tmp[3] = int(tmp[3])
+        tmp[4] = int(tmp[4])
+        tmp[7] = int(tmp[7])
+        tmp[8] = float(tmp[8])
+        output.append(tmp)
+    inH.close()
+    return output
@@ -2,6 +2,8 @@ import os
 import re
 import imp
 import commands
+import ReRCoP_alignment
+import ReRCoP_bgzf
 
 
 def checkModule(module):
@@ -51,25 +53,31 @@ def checkDir(dirName):
             raise OSError("Cannot create directory: '%s'!" % dirName)
 
 
-def checkName(inFasta):
+def checkName(inFasta, names=None):
     '''
     This function checks the name of sequences in a fasta file and raises
     an error if there are duplicated names.
 
-    @param inFasta: input fasta file
+    @param inFasta: input fasta file, plain or gzip compressed
+    @param names: the sequence names of inFasta if already known, e.g. from
+    its fasta index, in which case the file is not read again
     '''
+    if names is None:
+        names = []
+        pat = re.compile(">(\S+)")
+        inH = ReRCoP_bgzf.openInput(inFasta)
+        for line in inH:
+            if line.startswith('>'):
+                names.append(re.search(pat,line).group(1))
+        inH.close()
+
     storage = set()
     duplicate = set()
-    pat = re.compile(">(\S+)")
-    inH = open(inFasta)
-    for line in inH:
-        if line.startswith('>'):
-            name = re.search(pat,line).group(1)
-            if name in storage and name not in duplicate:
-                duplicate.add(name)
-            else:
-                storage.add(name)
-    inH.close()
+    for name in names:
+        if name in storage and name not in duplicate:
+            duplicate.add(name)
+        else:
+            storage.add(name)
     if len(duplicate) > 0:
         raise IOError("Please check the sequence names in '%s'. Duplicate names: %s" % (inFasta, str(duplicate)))
 
@@ -79,8 +87,10 @@ def checkLen(inFasta):
     This function checks the lengths of the fasta sequences and raises
     an error if the lengths are not equal.
 
-    @param: inFasta: a fasta object
+    @param: inFasta: a fasta object or an Alignment
     '''
+    if isinstance(inFasta, ReRCoP_alignment.Alignment):
+        return                  # Rows of an Alignment always have equal lengths
     length = len(inFasta[inFasta.keys()[0]])
     for seq in inFasta:
         if len(inFasta[seq]) != length:
@@ -0,0 +1,178 @@
+import os
+import glob
+import hashlib
+import numpy
+import ReRCoP_alignment
+
+
+def fingerprint(files, params, parent=''):
+    '''
+    This function returns a fingerprint of the inputs of a stage: the path,
+    size and modification time of the input files, the parameter values and
+    the fingerprint of the stage it depends on. As for the fasta index, a
+    file is taken as changed when its size or modification time changed.
+
+    @param files: the input file names, None for missing inputs
+    @param params: a dict of the parameter values of the stage
+    @param parent: the fingerprint of the previous stage
+    @return a SHA-1 hex digest
+    '''
+    sha = hashlib.sha1()
+    sha.update(parent)
+    for infile in files:
+        if infile is None:
+            sha.update('\0-')
+            continue
+        info = os.stat(infile)
+        sha.update('\0%s\0%d\0%r' % (os.path.abspath(infile), info.st_size, info.st_mtime))
+    for key in sorted(params):
+        sha.update('\0%s=%r' % (key, params[key]))
+    return sha.hexdigest()
+
+
+def checkpointDir(directory):
+    '''
+    This function creates the checkpoint directory if it does not exist.
+
+    @param directory: the checkpoint directory
+    '''
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise OSError("Cannot create directory: '%s'!" % directory)
+
+
+def readCheckpoint(infile, key):
+    '''
+    This function reads in a checkpoint file if its fingerprint is the given
+    one.
+
+    @param infile: the checkpoint file in NumPy '.npz' format
+    @param key: the expected fingerprint
+    @return a dict of the arrays of the file, or None if the file is missing
+    or has another fingerprint
+    '''
+    if not os.path.isfile(infile):
+        return None
+    data = numpy.load(infile)
+    output = dict((name, data[name]) for name in data.files)
+    data.close()
+    if str(output.get('fingerprint')) != key:
+        return None
+    return output
+
+
+def writeCheckpoint(outfile, key, **arrays):
+    '''
+    This function writes a checkpoint file with its fingerprint. The file is
+    written under a temporary name and moved into place when complete.
+
+    @param outfile: the checkpoint file in NumPy '.npz' format
+    @param key: the fingerprint
+    @param arrays: the arrays to save
+    '''
+    outH = open(outfile + '.tmp', 'wb')
+    numpy.savez(outH, fingerprint=numpy.array(key), **arrays)
+    outH.close()
+    os.rename(outfile + '.tmp', outfile)
+
+
+def saveCore(directory, key, seqConcat, logConcat, regions):
+    '''
+    This function saves the core alignment and the concatenation log. The
+    sequences are saved as a raw '.npy' array that is memory mapped when
+    loaded, named after the fingerprint so that it cannot be taken for the
+    sequences of another run. The sequences of earlier runs are removed.
+
+    @param directory: the checkpoint directory
+    @param key: the fingerprint of the core stage
+    @param seqConcat: an Alignment of the concatenated genomes
+    @param logConcat: the concatenation log
+    @param regions: the alignment regions of the input making up seqConcat,
+    or None if the input was not aligned
+    '''
+    checkpointDir(directory)
+    seqFile = os.path.join(directory, 'core.%s.npy' % key)
+    for oldFile in glob.glob(os.path.join(directory, 'core.*.npy')):
+        if oldFile != seqFile:
+            os.remove(oldFile)
+    outH = open(seqFile + '.tmp', 'wb')
+    numpy.save(outH, numpy.ascontiguousarray(seqConcat.seqs))
+    outH.close()
+    os.rename(seqFile + '.tmp', seqFile)
+    writeCheckpoint(os.path.join(directory, 'core.npz'), key,
+                    names=numpy.array(seqConcat.names, dtype=str),
+                    logName=numpy.array([str(item[0]) for item in logConcat], dtype=str),
+                    logPos=numpy.array([[int(item[1]), int(item[2])] for item in logConcat], dtype=numpy.int64).reshape(-1, 2),
+                    hasRegions=numpy.array(regions is not None),
+                    regions=numpy.array(regions if regions is not None else [], dtype=numpy.int64).reshape(-1, 2))
+
+
+def loadCore(directory, key):
+    '''
+    This function loads the core alignment saved by 'saveCore' if it has the
+    given fingerprint.
+
+    @param directory: the checkpoint directory
+    @param key: the fingerprint of the core stage
+    @return [seqConcat, logConcat, regions] as given to 'saveCore', with the
+    sequences memory mapped, or None if there is no valid checkpoint
+    '''
+    data = readCheckpoint(os.path.join(directory, 'core.npz'), key)
+    seqFile = os.path.join(directory, 'core.%s.npy' % key)
+    if data is None or not os.path.isfile(seqFile):
+        return None
+    seqs = numpy.load(seqFile, mmap_mode='r')
+    names = data['names'].tolist()
+    if seqs.shape[0] != len(names):
+        return None
+    log = [[name, int(pos[0]), int(pos[1])] for name, pos in zip(data['logName'].tolist(), data['logPos'])]
+    regions = data['regions'].tolist() if bool(data['hasRegions']) else None
+    return [ReRCoP_alignment.Alignment(names, seqs), log, regions]
+
+
+def saveDiff(directory, key, diff, counts):
+    '''
+    This function saves the number of differences from the consensus in each
+    region of each genome, with the consensus and the per-column character
+    counts if they were computed.
+
+    @param directory: the checkpoint directory
+    @param key: the fingerprint of the difference stage
+    @param diff: the array returned by ReRCoP_matrix.regionDiff
+    @param counts: the BaseCounts of the core alignment, or None
+    '''
+    checkpointDir(directory)
+    arrays = {'diff':diff}
+    if counts is not None:
+        arrays['alphabet'] = counts.alphabet
+        arrays['counts'] = counts.counts
+        arrays['consensus'] = counts.consensus()
+    writeCheckpoint(os.path.join(directory, 'diff.npz'), key, **arrays)
+
+
+def loadDiff(directory, key, needCounts=False):
+    '''
+    This function loads the differences saved by 'saveDiff' if they have the
+    given fingerprint.
+
+    @param directory: the checkpoint directory
+    @param key: the fingerprint of the difference stage
+    @param needCounts: the character counts are needed, so a checkpoint
+    without them is not valid
+    @return [diff, counts] as given to 'saveDiff', or None if there is no
+    valid checkpoint
+    '''
+    data = readCheckpoint(os.path.join(directory, 'diff.npz'), key)
+    if data is None:
+        return None
+    counts = None
+    if 'counts' in data:
+        counts = ReRCoP_alignment.BaseCounts(0)
+        counts.alphabet = data['alphabet']
+        counts.counts = data['counts']
+    elif needCounts:
+        return None
+    return [data['diff'], counts]
@@ -1,31 +1,57 @@
 import math
-import copy
+import numpy
+import ReRCoP_alignment
 import ReRCoP_preprocessing
 
 
+def regionBounds(log):
+    '''
+    This function converts the regions of a concatenation log into arrays of
+    0-based start positions and exclusive end positions.
+
+    @param log: the concatenation log
+    @return [starts, ends] as two int arrays
+    '''
+    starts = numpy.array([int(item[1])-1 for item in log], dtype=numpy.intp)
+    ends = numpy.array([int(item[2]) for item in log], dtype=numpy.intp)
+    return [starts, ends]
+
+
+def mismatchIndex(ref, query):
+    '''
+    This function builds the cumulative number of differences between the
+    query sequence and the reference sequence, so that the number of
+    differences in any region can be read off in constant time.
+
+    @param ref: a string or uint8 array of the reference sequence
+    @param query: a string or uint8 array of the query sequence
+    @return an int array of length len(ref)+1 whose j-th value is the number
+    of differences in the first j positions
+    '''
+    ref = ReRCoP_alignment.encodeSeq(ref)
+    query = ReRCoP_alignment.encodeSeq(query)
+    index = numpy.zeros(len(ref)+1, dtype=numpy.int64)
+    numpy.cumsum(query != ref, out=index[1:])
+    return index
+
+
 def mutCount(ref, query, log):
     '''
     This function compares the reference sequence and the query sequence
     and returns the number of differences in each gene as defined in the
     log file.
 
-    @param ref: a string of the reference sequence
-    @param query: a string of the query sequence
+    @param ref: a string or uint8 array of the reference sequence
+    @param query: a string or uint8 array of the query sequence
     @param log: the concatenation log
     @return [total, storage] with total the total nubmer of differences
     and storage a list with the number of differences in each region 
     defined in the log
     '''
-    storage = []
-    total = 0
-    for i in range(len(log)):
-        diff = 0
-        for j in range(int(log[i][1])-1,int(log[i][2])):
-            if query[j] != ref[j]:
-                diff += 1
-                total += 1
-        storage.append(diff)
-    return [total, storage] # [int, list]
+    index = mismatchIndex(ref, query)
+    [starts, ends] = regionBounds(log)
+    storage = (index[ends] - index[starts]).tolist()
+    return [sum(storage), storage] # [int, list]
 
 
 def median(inarr):
@@ -65,59 +91,200 @@ def stdDeviation(inarr):
     return math.sqrt(average(variance))
 
 
-def GeneDiff(record, inFasta):
+def rowAverage(mat, keep=None):
     '''
-    This function calculates the relative number of SNPs
+    This function calculates the mean of each row of a matrix, summing the
+    values from left to right as 'average' does.
+
+    @param mat: a 2-D float array
+    @param keep: a 2-D boolean array of the values to include [Default: all]
+    @return a 1-D float array
+    '''
+    if mat.shape[1] == 0:
+        return numpy.zeros(mat.shape[0])
+    if keep is None:
+        return numpy.cumsum(mat, axis=1)[:, -1] * 1.0 / mat.shape[1]
+    # Left out values are summed as zeros, which leaves the sums unchanged
+    return numpy.cumsum(numpy.where(keep, mat, 0), axis=1)[:, -1] * 1.0 / keep.sum(axis=1)
+
+
+def rowStdDeviation(mat, keep=None):
+    '''
+    This function calculates the standard deviation of each row of a matrix
+    as 'stdDeviation' does.
+
+    @param mat: a 2-D float array
+    @param keep: a 2-D boolean array of the values to include [Default: all]
+    @return a 1-D float array
+    '''
+    avg = rowAverage(mat, keep)
+    dev = mat - avg[:, None]
+    # Squared with pow() as for a float in 'stdDeviation', which may differ
+    # from dev*dev in the last bit
+    return numpy.sqrt(rowAverage(numpy.power(dev, numpy.full(dev.shape, 2.0)), keep))
+
+
+def regionDiff(record, inFasta, ref, profile=None):
+    '''
+    This function counts the differences from the reference sequence in each
+    region of each sequence, using one mismatch index per sequence.
 
     @param record: the log file returned by concatenation
-    @param inFasta: fasta object of the sequence concatenations
-    @return list of list of relative number of SNPs
+    @param inFasta: an Alignment of the sequence concatenations
+    @param ref: a uint8 array of the reference sequence
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    @return an int array of shape (number of sequences, number of regions)
     '''
-    ref = ReRCoP_preprocessing.consensus(inFasta)
+    [starts, ends] = regionBounds(record)
+    diff = numpy.zeros((len(inFasta), len(record)), dtype=numpy.int64)
+    for i in xrange(len(inFasta)):
+        index = mismatchIndex(ref, inFasta.row(i))
+        diff[i] = index[ends] - index[starts]
+        if profile is not None:
+            profile.progress('genomes', i+1, len(inFasta))
+    return diff
 
-    output = [[0 for i in xrange(len(inFasta)+3)] for j in xrange(len(record)+1)]
-    allSum = []
 
-    output[0][0] = "Name"
-    output[0][1] = "From"
-    output[0][2] = "To"
+def regionBlocks(starts, ends, width):
+    '''
+    This function groups consecutive regions into blocks spanning at most the
+    given number of columns. A region longer than that is a block on its own.
+
+    @param starts: the 0-based start of each region
+    @param ends: the exclusive end of each region
+    @param width: the maximum number of columns spanned by a block
+    @return a list of list [[first region, last region (exclusive), start
+    column, end column], ...]
+    '''
+    starts = starts.tolist()
+    ends = ends.tolist()
+    output = []
+    first = 0
+    while first < len(starts):
+        start = starts[first]
+        end = ends[first]
+        last = first + 1
+        while last < len(starts) and max(end, ends[last]) - min(start, starts[last]) <= width:
+            start = min(start, starts[last])
+            end = max(end, ends[last])
+            last += 1
+        output.append([first, last, start, end])
+        first = last
+    return output
 
-    storage = []
-    for header in inFasta:
-        [tmp1, tmp2] = mutCount(ref, inFasta[header], record)
-        storage.append([header, tmp1, tmp2])
-        allSum.append(tmp1)
-    
-    totalMedian = median(allSum)
 
-    for m in range(len(storage)):
-        output[0][m+3] = storage[m][0]
+def blockDiff(record, inFasta, blockSize, counts=None, profile=None):
+    '''
+    This function counts the differences from the consensus in each region of
+    each sequence, walking through the regions in blocks. The consensus and
+    the mismatches are computed for the columns spanned by one block of
+    regions at a time, and the mismatches one sequence at a time, so that
+    memory is bounded by the number of cells of a block.
 
-    for i in range(len(record)):
-        output[i+1][0] = record[i][0]
-        output[i+1][1] = record[i][1]
-        output[i+1][2] = record[i][2]
-        for j in range(len(storage)):
-            output[i+1][j+3] = int(storage[j][2][i]) * int(totalMedian) * 1.0 / storage[j][1]
+    @param record: the log file returned by concatenation
+    @param inFasta: an Alignment of the sequence concatenations
+    @param blockSize: the number of alignment cells (sequences x columns) in
+    each block, see ReRCoP_alignment.blockWidth
+    @param counts: a BaseCounts to fill with the character counts of the
+    columns covered by the regions, if they are needed later
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    @return an int array of shape (number of sequences, number of regions)
+    '''
+    [starts, ends] = regionBounds(record)
+    diff = numpy.zeros((len(inFasta), len(record)), dtype=numpy.int64)
+    done = 0
+    for [first, last, start, end] in regionBlocks(starts, ends, ReRCoP_alignment.blockWidth(len(inFasta), blockSize)):
+        block = inFasta.columns(start, end)
+        local = ReRCoP_alignment.BaseCounts(end-start)
+        local.add(block)
+        if counts is not None and end > done:
+            counts.add(block[:, max(done, start)-start:], max(done, start))
+            done = end
+        ref = local.consensus()
+        for i in xrange(block.shape[0]):
+            index = mismatchIndex(ref, block[i])
+            diff[i, first:last] = index[ends[first:last]-start] - index[starts[first:last]-start]
+        if profile is not None:
+            profile.progress('regions', last, len(record))
+    return diff
+
+
+def scaleDiff(record, names, diff):
+    '''
+    This function scales the number of differences in each region by the
+    total number of differences of each sequence and the median total, and
+    lays them out as the SNP matrix.
+
+    @param record: the log file returned by concatenation
+    @param names: the sequence names in the row order of diff
+    @param diff: the array returned by 'regionDiff'
+    @return list of list of relative number of SNPs
+    '''
+    total = diff.sum(axis=1)
+    if (total == 0).any():
+        raise ZeroDivisionError("No differences from the consensus in sequence '%s'!" % names[numpy.flatnonzero(total == 0)[0]])
+    totalMedian = median(total.tolist())
 
+    output = [["Name", "From", "To"] + list(names)]
+    scaled = (diff * int(totalMedian)).astype(numpy.float64) / total[:, None]
+    for i in range(len(record)):
+        output.append([record[i][0], record[i][1], record[i][2]] + scaled[:, i].tolist())
     return output
 
 
-def methodMat(source):
+def GeneDiff(record, inFasta, counts=None, blockSize=None):
+    '''
+    This function calculates the relative number of SNPs
+
+    @param record: the log file returned by concatenation
+    @param inFasta: fasta object or Alignment of the sequence concatenations
+    @param counts: the BaseCounts of inFasta if already computed by 'consensus'
+    @param blockSize: if set, stream through the regions in blocks of this
+    many alignment cells (see 'blockDiff') instead of building the full
+    consensus
+    @return list of list of relative number of SNPs
+    '''
+    inFasta = ReRCoP_alignment.toAlignment(inFasta)
+    if blockSize:
+        return scaleDiff(record, inFasta.names, blockDiff(record, inFasta, blockSize))
+    if counts is None:
+        [ref, counts] = ReRCoP_preprocessing.consensus(inFasta)
+    else:
+        ref = counts.consensus()
+    return scaleDiff(record, inFasta.names, regionDiff(record, inFasta, ref))
+
+
+def methodMat(source, mask=None):
     '''
     This function makes a copy of the SNPmat, maintains the descriptive features
     and set all other values to 0.
 
     @param source: the SNPmat to copy
+    @param mask: a 2-D boolean array with one row per region of the SNPmat, the
+    values to set to 1 instead [Default: none]
     @return a matrix with the values set to 0
     '''
-    mat = copy.deepcopy(source)
-    for i in range(1,len(mat)):
-        for j in range(3, len(mat[0])):
-            mat[i][j] = 0
+    mat = [source[0][:]]
+    nCol = len(source[0]) - 3
+    for i in range(1,len(source)):
+        if mask is None:
+            mat.append(source[i][:3] + [0] * nCol)
+        else:
+            mat.append(source[i][:3] + mask[i-1].astype(int).tolist())
     return mat
 
 
+def snpArray(source):
+    '''
+    This function returns the values of the SNPmat as a 2-D float array with
+    one row per region and one column per genome.
+
+    @param source: the SNPmat
+    @return a 2-D float array
+    '''
+    return numpy.array([row[3:] for row in source[1:]], dtype=numpy.float64).reshape(len(source)-1, len(source[0])-3)
+
+
 def sdSelection(inarr, perc):
     '''
     This function adjust the standard deviation to reduce the effect of outliers.
@@ -127,27 +294,75 @@ def sdSelection(inarr, perc):
     toward the standard deviation calculation
     @return the adjusted standard deviation.
     '''
-    arr = inarr[:]
-
-    while True:
-        if len(arr) <= 2:
-            return stdDeviation(inarr)    # Values are too diverse
-
-        sd = stdDeviation(arr)
-        if sd == 0:
-            return 0.000001                             # Values are the same
+    return sdSelectionMat(numpy.array(inarr, dtype=numpy.float64).reshape(1, len(inarr)), perc)[0]
 
-        deviation = [stdDeviation(arr[:i]+arr[i+1:])/sd for i in range(len(arr))]
-        removal = []
-        for i in range(len(deviation)):
-            if (deviation[i] > 1+perc) or (deviation[i]<1-perc):
-                removal.append(i)
 
-        if len(removal) == 0:
-            return sd
-        else:
-            for index in sorted(removal, reverse=True):
-                del arr[index]
-
-    return stdDeviation(arr)
+def sdSelectionMat(mat, perc):
+    '''
+    This function adjusts the standard deviation of each row of a matrix as
+    'sdSelection' does. In each round, the leave-one-out deviations of all
+    the points are derived from the sums of the values centered on the mean.
+    The few points whose deviation is too close to a cutoff for these sums to
+    decide are checked with the leave-one-out deviation computed in full.
 
+    @param mat: a 2-D float array
+    @param perc: the percentage deviation for define a point as not to be included
+    toward the standard deviation calculation
+    @return a 1-D float array of the adjusted standard deviations
+    '''
+    [nRow, n] = mat.shape
+    output = numpy.zeros(nRow)
+    keep = numpy.ones(mat.shape, dtype=bool)
+    active = numpy.arange(nRow)
+    eps = numpy.finfo(numpy.float64).eps
+    while len(active) > 0:
+        m = keep[active].sum(axis=1)
+        few = m <= 2
+        if few.any():
+            output[active[few]] = rowStdDeviation(mat[active[few]])    # Values are too diverse
+        active = active[~few]
+        m = m[~few]
+        if len(active) == 0:
+            break
+
+        sub = mat[active]
+        subKeep = keep[active]
+        avg = rowAverage(sub, subKeep)
+        sd = rowStdDeviation(sub, subKeep)
+        same = sd == 0
+        output[active[same]] = 0.000001                                # Values are the same
+        [active, m, sub, subKeep, avg, sd] = [item[~same] for item in [active, m, sub, subKeep, avg, sd]]
+        if len(active) == 0:
+            break
+
+        # Leave-one-out variances from the sums of the centered values
+        d = numpy.where(subKeep, sub - avg[:, None], 0)
+        k = (m - 1)[:, None].astype(numpy.float64)
+        D1 = d.sum(axis=1)[:, None]
+        D2 = (d*d).sum(axis=1)[:, None]
+        rest = (D1 - d) / k
+        var = (D2 - d*d) / k - rest**2
+        high = (((1+perc) * sd)**2)[:, None]
+        low = (((1-perc) * sd)**2)[:, None]
+        # Bound on the rounding errors of var and of the full computation,
+        # including those of the means the values are centered on
+        shift = n * eps * numpy.where(subKeep, numpy.abs(sub), 0).max(axis=1)[:, None]
+        tol = 16 * (n * eps * ((D2 + d*d + numpy.abs(d).sum(axis=1)[:, None] * numpy.abs(rest)) / k + numpy.abs(var) + high)
+                    + shift * (numpy.sqrt(D2 / k) + numpy.sqrt(numpy.abs(var))) + shift**2)
+        removal = var > high + tol
+        unsure = numpy.abs(var - high) <= tol
+        if 1-perc > 0:
+            removal |= var < low - tol
+            unsure |= numpy.abs(var - low) <= tol
+        removal &= subKeep
+        unsure &= subKeep
+        for [r, i] in zip(*numpy.nonzero(unsure)):
+            index = numpy.flatnonzero(subKeep[r])
+            deviation = stdDeviation(sub[r, index[index != i]].tolist()) / sd[r]
+            removal[r, i] = (deviation > 1+perc) or (deviation < 1-perc)
+
+        done = ~removal.any(axis=1)
+        output[active[done]] = sd[done]
+        keep[active[~done]] &= ~removal[~done]
+        active = active[~done]
+    return output
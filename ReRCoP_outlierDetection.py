@@ -1,12 +1,13 @@
 import math
 import random
-from scipy import stats
+import numpy
 import ReRCoP_matrix
 
 
 def kNN(inarr, Pk, Pthreshold):
     '''
-    This function implements the kNN outlier detection.
+    This function implements the kNN outlier detection. The neighbors of each
+    point are counted on the sorted points with 'neighborBounds'.
 
     @param inarr: input numerical array
     @param Pk: k value in the kNN method input as a percentage of the number 
@@ -20,78 +21,37 @@ def kNN(inarr, Pk, Pthreshold):
     threshold = Pthreshold * sd	# Threshold used to define a neighbor
     k = int(total * Pk)		# k value in the kNN method
 
-    outlier = []
-    for i in range(total):
-        count = 0
-        for j in range(total):
-            if abs(inarr[i] - inarr[j]) <= threshold:
-                count += 1
-                if count >=k:
-                    break
-        if count < k:
-            outlier.append(i)
-    return outlier
+    arr = numpy.array(inarr, dtype=numpy.float64).reshape(1, total)
+    [lo, hi] = neighborBounds(numpy.sort(arr, axis=1), arr, numpy.array([threshold]))
+    return numpy.flatnonzero(hi[0] - lo[0] < k).tolist()
 
 
-def Grubbs(inarr, alpha):
+def Grubbs(inarr, alpha, iterative=False):
     '''
     This function implements the Grubb's outlier detectoin.
 
     @param inarr: input numerical array
     @param alpha: significance level for the statistical test
+    @param iterative: repeat the test on the remaining points until no more
+    outliers are found
     @return a list of indices of the outliers
     '''
-    avg = ReRCoP_matrix.average(inarr)
-    std = ReRCoP_matrix.stdDeviation(inarr)
-    if std == 0:
-        return []
-    G = [abs(item - avg)/std for item in inarr]
-    N = len(inarr)
-    t = stats.t.isf(1-alpha/(2*N), N-2)
-    Gtest = (N-1)/math.sqrt(N) * math.sqrt(t**2 / (N-2+t**2))
     outlier = []
-    for i in range(len(G)):
-        if G[i] > Gtest:
-            outlier.append(i)
-    return outlier
-
-
-def region_query(inarr, point, eps):
-    '''
-    This is a helper function for 'DBSCAN'
-    '''
-    nP = len(inarr)
-    seeds = []
-    for i in range(nP):
-        if abs(inarr[point] - inarr[i]) < eps:
-            seeds.append(i)
-    return seeds
-
-
-def expand_cluster(inarr, classification, point, cluster, eps, minP):
-    '''
-    This is a helper function for 'DBSCAN'
-    '''
-    seeds = region_query(inarr, point, eps)
-    if len(seeds) < minP:
-        classification[point] = -1
-        return False
-    else:
-        classification[point] = cluster
-        for seed in seeds:
-            classification[seed] = cluster
-
-        while len(seeds) > 0:
-            currentP = seeds[0]
-            results = region_query(inarr, currentP, eps)
-            if len(results) >= minP:
-                for result in results:
-                    if classification[result] in [0,-1]:
-                        if classification[result] == 0:
-                            seeds.append(result)
-                    classification[result] = cluster
-            seeds = seeds[1:]
-        return True
+    remain = range(len(inarr))
+    while True:
+        arr = [inarr[i] for i in remain]
+        avg = ReRCoP_matrix.average(arr)
+        std = ReRCoP_matrix.stdDeviation(arr)
+        if std == 0:
+            break
+        N = len(arr)
+        Gtest = criticalValue(N, alpha)
+        found = [remain[i] for i in range(N) if abs(arr[i] - avg)/std > Gtest]
+        outlier += found
+        if not iterative or len(found) == 0 or N - len(found) < 3:
+            break
+        remain = [i for i in remain if i not in found]
+    return sorted(outlier)
 
 
 def DBSCAN(inarr, Peps, PminP):
@@ -105,19 +65,339 @@ def DBSCAN(inarr, Peps, PminP):
     the total number of points
     @return a list of indices of the outliers
     '''
-    cluster = 1
     totalP = len(inarr)
     minP = int(totalP * PminP)
     sd = ReRCoP_matrix.sdSelection(inarr, 0.15)       # Estimated sd of the non-outlier points
     eps = Peps * sd
-    classification = [0 for i in xrange(totalP)]
-    for point in range(totalP):
-        if classification[point] == 0:
-            if expand_cluster(inarr, classification, point, cluster, eps, minP):
-                cluster += 1
-    outlier = []
-    for i in range(len(classification)):
-        if classification[i] == -1:
-            outlier.append(i)
-    return outlier
+    arr = numpy.array(inarr, dtype=numpy.float64).reshape(1, totalP)
+    return numpy.flatnonzero(noise(arr, numpy.array([eps]), minP)[0]).tolist()
+
+
+def noise(mat, eps, minP, stats=None):
+    '''
+    This function finds the points of each row of a matrix left as noise by
+    the DBSCAN clustering. A point is noise if and only if it is not a core
+    point, i.e. it has fewer than minP points closer than eps, and there is
+    no core point closer than eps to it. Both are counted on the sorted row,
+    so the clusters themselves need not be built.
+
+    @param mat: a 2-D float array
+    @param eps: a 1-D float array, the eps value of each row
+    @param minP: minimum number of points in the neighborhood of a core point
+    @param stats: the RowStats of mat [Default: computed]
+    @return a 2-D boolean array marking the noise
+    '''
+    if stats is None:
+        stats = RowStats(mat)
+    [nRow, n] = mat.shape
+    order = stats.order
+    rows = numpy.arange(nRow)[:, None]
+    [lo, hi] = neighborBounds(stats.sorts, stats.sorts, eps, True, stats.blocks)
+    hi = numpy.maximum(hi, lo)
+    core = hi - lo >= minP
+    cores = numpy.zeros((nRow, n+1), dtype=numpy.intp)
+    numpy.cumsum(core, axis=1, out=cores[:, 1:])
+    mask = numpy.empty(mat.shape, dtype=bool)
+    mask[rows, order] = ~core & (cores[rows, hi] == cores[rows, lo])
+    return mask
+
+
+class RowStats(object):
+    '''
+    This class holds the statistics of the rows of a matrix that are shared
+    by the outlier detection methods: the mean and standard deviation of each
+    row, and the sorted order of each row with its runs of equal values. The
+    sorted order is only computed when first used.
+    '''
+
+    def __init__(self, mat):
+        '''
+        @param mat: a 2-D float array
+        '''
+        self.mat = mat
+        self.average = ReRCoP_matrix.rowAverage(mat)
+        self.std = ReRCoP_matrix.rowStdDeviation(mat)
+        self._order = None
+        self._blocks = None
+
+    @property
+    def order(self):
+        '''
+        The indices sorting each row, as a 2-D int array.
+        '''
+        if self._order is None:
+            self._order = numpy.argsort(self.mat, axis=1, kind='mergesort')
+            self._sorts = self.mat[numpy.arange(self.mat.shape[0])[:, None], self._order]
+        return self._order
+
+    @property
+    def sorts(self):
+        '''
+        The sorted rows, as a 2-D float array.
+        '''
+        self.order
+        return self._sorts
+
+    @property
+    def blocks(self):
+        '''
+        The runs of equal values of the sorted rows, as returned by 'tieBlocks'.
+        '''
+        if self._blocks is None:
+            self._blocks = tieBlocks(self.sorts)
+        return self._blocks
+
+
+def outlierMats(mat, methods, alpha=0.05, iterative=False, Pk=0.2, Pthreshold=1.5, Peps=1, PminP=0.2):
+    '''
+    This function runs the given outlier detection methods on every row of a
+    matrix in one pass over blocks of rows, computing the statistics shared
+    by the methods once per block.
+
+    @param mat: a 2-D float array with one row per region and one column per
+    genome
+    @param methods: a list of methods among 'Grubbs', 'kNN' and 'DBSCAN'
+    @param alpha, iterative: the parameters of 'GrubbsMat'
+    @param Pk, Pthreshold: the parameters of 'kNNMat'
+    @param Peps, PminP: the parameters of 'DBSCANMat'
+    @return a dict of the 2-D boolean array marking the outliers of each
+    method
+    '''
+    [nRow, nCol] = mat.shape
+    masks = dict((method, numpy.zeros(mat.shape, dtype=bool)) for method in methods)
+    step = rowBlock(nRow, nCol)
+    for start in xrange(0, nRow, step):
+        block = mat[start:start+step]
+        stats = RowStats(block)
+        if 'Grubbs' in masks:
+            masks['Grubbs'][start:start+step] = GrubbsMat(block, alpha, iterative, stats)
+        if 'kNN' in masks:
+            masks['kNN'][start:start+step] = kNNMat(block, Pk, Pthreshold, stats)
+        if 'DBSCAN' in masks:
+            masks['DBSCAN'][start:start+step] = DBSCANMat(block, Peps, PminP, stats)
+    return masks
+
+
+def rowBlock(nRow, nCol, cells=1<<22):
+    '''
+    This function returns a number of rows of a matrix with nCol columns such
+    that a block of rows holds about the given number of cells.
+    '''
+    return max(1, min(nRow, cells // max(1, nCol)))
+
+
+def rowSearch(sorts, values, side):
+    '''
+    This function finds the indices into each row of a row-sorted matrix at
+    which the values of the same row of another matrix would be inserted, as
+    numpy.searchsorted does for one row. All the rows are merged with a
+    single stable sort.
+
+    @param sorts: a 2-D array with each row sorted
+    @param values: a 2-D array with the same number of rows
+    @param side: 'left' or 'right' as in numpy.searchsorted
+    @return a 2-D int array of the shape of values
+    '''
+    [nRow, n] = sorts.shape
+    m = values.shape[1]
+    if side == 'left':
+        # Values placed first come before the sorted values equal to them
+        merged = numpy.hstack([values, sorts])
+        offset = 0
+    else:
+        merged = numpy.hstack([sorts, values])
+        offset = n
+    order = numpy.argsort(merged, axis=1, kind='mergesort')
+    isValue = (order >= offset) & (order < offset + m)
+    before = numpy.cumsum(~isValue, axis=1)
+    index = numpy.empty((nRow, m), dtype=numpy.intp)
+    [rows, cols] = numpy.nonzero(isValue)
+    index[rows, order[rows, cols] - offset] = before[rows, cols]
+    return index
+
 
+def tieBlocks(sorts):
+    '''
+    This function finds the run of equal values around each element of a
+    row-sorted matrix.
+
+    @param sorts: a 2-D array with each row sorted
+    @return [first, end], 2-D int arrays of the index of the first element of
+    the run and of one past its last element
+    '''
+    [nRow, n] = sorts.shape
+    col = numpy.arange(n)
+    start = numpy.ones(sorts.shape, dtype=bool)
+    start[:, 1:] = sorts[:, 1:] != sorts[:, :-1]
+    stop = numpy.ones(sorts.shape, dtype=bool)
+    stop[:, :-1] = start[:, 1:]
+    first = numpy.maximum.accumulate(numpy.where(start, col, 0), axis=1)
+    end = numpy.minimum.accumulate(numpy.where(stop, col+1, n)[:, ::-1], axis=1)[:, ::-1]
+    return [first, end]
+
+
+def neighborBounds(sorts, values, radius, strict=False, blocks=None):
+    '''
+    This function finds, for each value, the points of the same row of a
+    row-sorted matrix within a radius of it, i.e. with abs(value - point) <=
+    radius, or < radius if strict. As the rounded differences are monotonic
+    in the point, these points make up one range of the sorted row. The range
+    is first found by binary search on value - radius and value + radius,
+    and its ends are then moved over runs of equal points until they agree
+    with the differences themselves.
+
+    @param sorts: a 2-D float array with each row sorted
+    @param values: a 2-D float array with the same number of rows
+    @param radius: a 1-D float array, the non-negative radius of each row
+    @param strict: count only the points closer than the radius
+    @param blocks: the runs of equal values of sorts as returned by
+    'tieBlocks' [Default: computed]
+    @return [lo, hi], 2-D int arrays of the shape of values such that the
+    points are sorts[row, lo:hi] (none if hi <= lo)
+    '''
+    [nRow, n] = sorts.shape
+    radius = radius[:, None]
+    lo = rowSearch(sorts, values - radius, 'left')
+    hi = rowSearch(sorts, values + radius, 'right')
+    if n == 0 or values.size == 0:
+        return [lo, hi]
+    if strict:
+        near = lambda point: numpy.abs(values - point) < radius
+    else:
+        near = lambda point: numpy.abs(values - point) <= radius
+    if blocks is None:
+        blocks = tieBlocks(sorts)
+    [first, end] = blocks
+    rows = numpy.arange(nRow)[:, None]
+    while True:
+        moved = False
+        i = numpy.maximum(lo-1, 0)
+        move = (lo > 0) & near(sorts[rows, i])
+        if move.any():
+            lo = numpy.where(move, first[rows, i], lo)
+            moved = True
+        i = numpy.minimum(lo, n-1)
+        move = (lo < n) & (sorts[rows, i] <= values) & ~near(sorts[rows, i])
+        if move.any():
+            lo = numpy.where(move, end[rows, i], lo)
+            moved = True
+        i = numpy.minimum(hi, n-1)
+        move = (hi < n) & near(sorts[rows, i])
+        if move.any():
+            hi = numpy.where(move, end[rows, i], hi)
+            moved = True
+        i = numpy.maximum(hi-1, 0)
+        move = (hi > 0) & (sorts[rows, i] >= values) & ~near(sorts[rows, i])
+        if move.any():
+            hi = numpy.where(move, first[rows, i], hi)
+            moved = True
+        if not moved:
+            return [lo, hi]
+
+
+# Critical values of the Grubb's test computed so far, keyed by (N, alpha)
+criticalValues = {}
+
+
+def criticalValue(N, alpha):
+    '''
+    This function calculates the critical value of the Grubb's test. The
+    values are kept in 'criticalValues' as they only depend on the number of
+    points and the significance level. SciPy is only imported here, so that
+    the other methods can be used without loading it.
+
+    @param N: the number of points
+    @param alpha: significance level for the statistical test
+    @return the critical value
+    '''
+    key = (N, alpha)
+    if key not in criticalValues:
+        from scipy import stats
+        t = stats.t.isf(1-alpha/(2*N), N-2)
+        criticalValues[key] = (N-1)/math.sqrt(N) * math.sqrt(t**2 / (N-2+t**2))
+    return criticalValues[key]
+
+
+def GrubbsMat(mat, alpha, iterative=False, stats=None):
+    '''
+    This function implements the Grubb's outlier detection of 'Grubbs' for
+    every row of a matrix at once. In the iterative mode, the rows with new
+    outliers are tested again on their remaining points.
+
+    @param mat: a 2-D float array with one row per region and one column per
+    genome
+    @param alpha: significance level for the statistical test
+    @param iterative: repeat the test on the remaining points until no more
+    outliers are found
+    @param stats: the RowStats of mat [Default: computed]
+    @return a 2-D boolean array marking the outliers
+    '''
+    mask = numpy.zeros(mat.shape, dtype=bool)
+    if mat.shape[1] == 0:
+        return mask
+    if stats is None:
+        stats = RowStats(mat)
+    active = numpy.arange(mat.shape[0])
+    [avg, std] = [stats.average, stats.std]
+    while len(active) > 0:
+        sub = mat[active]
+        keep = ~mask[active]
+        N = keep.sum(axis=1)
+        if mask.any():                  # Not the first test, on all the points
+            avg = ReRCoP_matrix.rowAverage(sub, keep)
+            std = ReRCoP_matrix.rowStdDeviation(sub, keep)
+        [sizes, inverse] = numpy.unique(N, return_inverse=True)
+        Gtest = numpy.array([criticalValue(int(n), alpha) for n in sizes])[inverse]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            found = keep & (numpy.abs(sub - avg[:, None]) / std[:, None] > Gtest[:, None])
+        found[std == 0] = False
+        mask[active] |= found
+        if not iterative:
+            break
+        nFound = found.sum(axis=1)
+        active = active[(nFound > 0) & (N - nFound >= 3)]
+    return mask
+
+
+def kNNMat(mat, Pk, Pthreshold, stats=None):
+    '''
+    This function implements the kNN outlier detection of 'kNN' for every row
+    of a matrix at once, counting the neighbors of each point on the sorted
+    row.
+
+    @param mat: a 2-D float array with one row per region and one column per
+    genome
+    @param Pk: k value in the kNN method input as a percentage of the number
+    of points
+    @param Pthreshold: threshold used to define a neighbor input as a factor
+    of the standard deviation
+    @param stats: the RowStats of mat [Default: computed in blocks of rows]
+    @return a 2-D boolean array marking the outliers
+    '''
+    if stats is None:
+        return outlierMats(mat, ['kNN'], Pk=Pk, Pthreshold=Pthreshold)['kNN']
+    threshold = Pthreshold * stats.std
+    k = int(mat.shape[1] * Pk)
+    [lo, hi] = neighborBounds(stats.sorts, mat, threshold, False, stats.blocks)
+    return hi - lo < k
+
+
+def DBSCANMat(mat, Peps, PminP, stats=None):
+    '''
+    This function implements the DBSCAN outlier detection of 'DBSCAN' for
+    every row of a matrix at once.
+
+    @param mat: a 2-D float array with one row per region and one column per
+    genome
+    @param Peps: eps value in the DBSCAN method input as a factor of the
+    standard deviation
+    @param PminP: minP value in the DBSCAN method input as a percentage of
+    the total number of points
+    @param stats: the RowStats of mat [Default: computed in blocks of rows]
+    @return a 2-D boolean array marking the outliers
+    '''
+    if stats is None:
+        return outlierMats(mat, ['DBSCAN'], Peps=Peps, PminP=PminP)['DBSCAN']
+    minP = int(mat.shape[1] * PminP)
+    eps = Peps * ReRCoP_matrix.sdSelectionMat(mat, 0.15)    # Estimated sd of the non-outlier points
+    return noise(mat, eps, minP, stats)
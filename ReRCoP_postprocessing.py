@@ -1,5 +1,8 @@
-import copy
-import ReRCoP_preprocessing
+import struct
+import zipfile
+import numpy
+import ReRCoP_alignment
+import ReRCoP_bgzf
 
 
 def mergeInterval(intervals):
@@ -20,41 +23,150 @@ def mergeInterval(intervals):
     return output
 
 
-def removeOutlier(inFasta, inMat):
+def outlierTable(inMat):
     '''
-    This function removes the outlier genes from the aligned fasta file generated by sliding window.
+    This function reads the outlier regions of the matrix (Outliermat) into
+    arrays.
 
-    @param inFasta: a fasta object of the input genome
     @param inMat: the matrix (Outliermat) recording the outlier genes
-    @return a fasta object with outlier genes removed.
+    @return [column, starts, ends, flags]: a dict of the column of each
+    sequence in flags, int arrays of the 1-based start and end of each
+    region, and a 2-D boolean array with one row per region and one column
+    per sequence marking the outliers
     '''
-    fasta = copy.deepcopy(inFasta)
+    names = inMat[0][3:]
+    column = dict((name, i) for i, name in enumerate(names))
+    starts = numpy.array([int(row[1]) for row in inMat[1:]], dtype=numpy.int64)
+    ends = numpy.array([int(row[2]) for row in inMat[1:]], dtype=numpy.int64)
+    flags = numpy.array([row[3:] for row in inMat[1:]], dtype=numpy.int64).reshape(len(inMat)-1, len(names)) == 1
+    return [column, starts, ends, flags]
+
 
-    for i in range(3,len(inMat[0])):
-        oInterval = []
-        for j in range(1,len(inMat)):
-            if inMat[j][i] == 1:
-                oInterval.append([inMat[j][1], inMat[j][2]])
-        merged = mergeInterval(oInterval)
+def maskIndex(starts, ends):
+    '''
+    This function returns the positions covered by a set of intervals, each
+    position once. The intervals are merged as in 'mergeInterval' and their
+    positions laid out without a loop over the intervals.
 
-        for pair in merged:
-            pair = map(int, pair)
-            fasta[inMat[0][i]] = fasta[inMat[0][i]][:pair[0]-1] + '-'*(pair[1]-pair[0]+1) + fasta[inMat[0][i]][pair[1]:]
+    @param starts: int array of the 1-based starts of the intervals
+    @param ends: int array of the 1-based ends of the intervals, inclusive
+    @return a sorted int array of 0-based positions
+    '''
+    if len(starts) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.argsort(starts, kind='mergesort')
+    starts = starts[order] - 1
+    reach = numpy.maximum.accumulate(ends[order])
+    new = numpy.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    first = starts[new]
+    last = reach[numpy.append(numpy.flatnonzero(new)[1:] - 1, len(starts) - 1)]
+    lengths = last - first
+    offsets = numpy.cumsum(lengths) - lengths
+    return numpy.arange(lengths.sum()) + numpy.repeat(first - offsets, lengths)
+
+
+def maskRow(row, starts, ends):
+    '''
+    This function replaces the given intervals of a sequence with gaps, in place.
+
+    @param row: a uint8 array of the sequence
+    @param starts: int array of the 1-based starts of the intervals
+    @param ends: int array of the 1-based ends of the intervals, inclusive
+    '''
+    row[maskIndex(starts, ends)] = ord('-')
+
+
+def removeOutlier(inFasta, inMat, outfile=None, compress=False, threads=1):
+    '''
+    This function removes the outlier genes from the aligned fasta file generated by sliding window.
+
+    @param inFasta: a fasta object or Alignment of the input genome
+    @param inMat: the matrix (Outliermat) recording the outlier genes
+    @param outfile: output fasta file. If given, each masked sequence is
+    written straight to it as by 'writeMasked' and nothing is returned
+    @param compress, threads: write outfile in BGZF format with the given
+    number of compressing threads
+    @return an Alignment with outlier genes removed.
+    '''
+    if outfile is not None:
+        writeMasked(inFasta, inMat, outfile, compress, threads)
+        return None
+    aln = ReRCoP_alignment.toAlignment(inFasta)
+    fasta = aln.copy()
+
+    [column, starts, ends, flags] = outlierTable(inMat)
+    for key in inMat[0][3:]:
+        index = numpy.flatnonzero(flags[:, column[key]])
+        maskRow(fasta.seqs[aln.index[key]], starts[index], ends[index])
 
     return fasta
 
 
-def writeFasta(inFasta, outfile):
+def writeMasked(inFasta, inMat, outfile, compress=False, threads=1):
+    '''
+    This function removes the outlier genes one sequence at a time and writes
+    each masked sequence straight to the output file, so that only one
+    sequence is copied in memory at any time.
+
+    @param inFasta: a fasta object or Alignment of the input genome
+    @param inMat: the matrix (Outliermat) recording the outlier genes
+    @param outfile: output fasta file
+    @param compress: write the output in BGZF format
+    @param threads: the number of compressing threads
+    '''
+    writeMaskedAll(inFasta, [inMat], [outfile], compress, threads)
+
+
+def writeMaskedAll(inFasta, inMats, outfiles, compress=False, threads=1, profile=None):
+    '''
+    This function does what 'writeMasked' does for several matrices (e.g. one
+    per outlier detection method) in a single pass over the sequences,
+    masking each sequence in one reused buffer.
+
+    @param inFasta: a fasta object or Alignment of the input genome
+    @param inMats: a list of matrices (Outliermat) recording the outlier genes
+    @param outfiles: the output fasta file of each matrix
+    @param compress: write the outputs in BGZF format
+    @param threads: the number of compressing threads of each output
+    @param profile: a ReRCoP_profile.Profile to report the progress to
+    '''
+    aln = ReRCoP_alignment.toAlignment(inFasta)
+    tables = [outlierTable(inMat) for inMat in inMats]
+    handles = [ReRCoP_bgzf.openOutput(outfile, compress, threads) for outfile in outfiles]
+    row = numpy.empty(aln.length, dtype=numpy.uint8)
+    for i, key in enumerate(aln.names):
+        source = aln.row(i)
+        for [column, starts, ends, flags], outH in zip(tables, handles):
+            row[:] = source
+            if key in column:
+                index = numpy.flatnonzero(flags[:, column[key]])
+                maskRow(row, starts[index], ends[index])
+            outH.write(">%s\n" % key)
+            outH.write(row)
+            outH.write("\n")
+        if profile is not None:
+            profile.progress('genomes', i+1, len(aln))
+    for outH in handles:
+        outH.close()
+
+
+def writeFasta(inFasta, outfile, compress=False, threads=1, profile=None):
     '''
     This function writes a fasta object into a fasta file
 
     @param inFasta: input fasta object
     @param outfile: output fasta file
+    @param compress: write the output in BGZF format
+    @param threads: the number of compressing threads
+    @param profile: a ReRCoP_profile.Profile to report the progress to
     '''
-    outH = open(outfile, 'w')
-    for key in inFasta:
+    outH = ReRCoP_bgzf.openOutput(outfile, compress, threads)
+    for i, key in enumerate(inFasta):
         outH.write(">%s\n" % key)
         outH.write("%s\n" % inFasta[key])
+        if profile is not None:
+            profile.progress('genomes', i+1, len(inFasta))
     outH.close()
 
 
@@ -72,3 +184,86 @@ def writeMat(inMat, outfile):
              outH.write("\t%s" % str(inMat[i][j]))
         outH.write('\n')
     outH.close()
+
+
+def writeMatNpz(inMat, outfile, packed=False):
+    '''
+    This function writes a matrix (SNPmat or Outliermat) to an uncompressed
+    NumPy '.npz' file, which can be memory-mapped by 'readMatNpz'. The file
+    holds the region names ('names'), the region starts and ends ('starts',
+    'ends'), the genome names ('genomes') and either the values as float32
+    ('snps') or the outlier flags packed eight genomes to a byte
+    ('outliers').
+
+    @param inMat: input matrix
+    @param outfile: output file
+    @param packed: write the values as packed outlier flags
+    '''
+    nRow = len(inMat) - 1
+    nCol = len(inMat[0]) - 3
+    arrays = {'names':numpy.array([str(row[0]) for row in inMat[1:]], dtype=str),
+              'starts':numpy.array([int(row[1]) for row in inMat[1:]], dtype=numpy.int64),
+              'ends':numpy.array([int(row[2]) for row in inMat[1:]], dtype=numpy.int64),
+              'genomes':numpy.array(inMat[0][3:], dtype=str)}
+    values = numpy.array([row[3:] for row in inMat[1:]], dtype=numpy.float64).reshape(nRow, nCol)
+    if packed:
+        arrays['outliers'] = numpy.packbits(values == 1, axis=1)
+    else:
+        arrays['snps'] = values.astype(numpy.float32)
+    outH = open(outfile, 'wb')
+    numpy.savez(outH, **arrays)
+    outH.close()
+
+
+def mapNpz(infile):
+    '''
+    This function memory-maps the arrays of a NumPy '.npz' file. Compressed
+    arrays are read into memory instead. Arrays of Python objects are not
+    loaded, as unpickling them could run arbitrary code.
+
+    @param infile: input file
+    @return a dict of the arrays by name
+    '''
+    output = {}
+    archive = zipfile.ZipFile(infile)
+    inH = open(infile, 'rb')
+    for info in archive.infolist():
+        name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+        if info.compress_type == zipfile.ZIP_STORED:
+            # Skip the local file header to the start of the '.npy' data
+            inH.seek(info.header_offset + 26)
+            [nameLen, extraLen] = struct.unpack('<HH', inH.read(4))
+            inH.seek(info.header_offset + 30 + nameLen + extraLen)
+            version = numpy.lib.format.read_magic(inH)
+            if version == (1, 0):
+                [shape, fortran, dtype] = numpy.lib.format.read_array_header_1_0(inH)
+            else:
+                [shape, fortran, dtype] = numpy.lib.format.read_array_header_2_0(inH)
+            if not dtype.hasobject and numpy.prod(shape) > 0:
+                output[name] = numpy.memmap(infile, dtype=dtype, mode='r', offset=inH.tell(), shape=shape, order='F' if fortran else 'C')
+                continue
+        output[name] = numpy.lib.format.read_array(archive.open(info), allow_pickle=False)
+    inH.close()
+    archive.close()
+    return output
+
+
+def readMatNpz(infile):
+    '''
+    This function reads in a matrix written by 'writeMatNpz', memory-mapping
+    its arrays.
+
+    @param infile: input file
+    @return a dict with the keys 'names', 'starts', 'ends', 'genomes' and
+    'values', the latter a 2-D float32 array of the SNPs or a 2-D boolean
+    array of the outlier flags with one row per region and one column per
+    genome
+    '''
+    arrays = mapNpz(infile)
+    output = dict((key, arrays[key]) for key in ['names', 'starts', 'ends', 'genomes'])
+    if 'outliers' in arrays:
+        nCol = len(arrays['genomes'])
+        output['values'] = numpy.unpackbits(arrays['outliers'], axis=1)[:, :nCol].astype(bool)
+    else:
+        output['values'] = arrays['snps']
+    return output
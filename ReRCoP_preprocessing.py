@@ -1,6 +1,17 @@
 import re
-import subprocess
 import os
+import multiprocessing
+import numpy
+import ReRCoP_alignment
+import ReRCoP_blast
+import ReRCoP_bgzf
+import ReRCoP_checkpoint
+
+
+# Lookup table of the characters counted as covered positions
+BASES = numpy.zeros(256, dtype=bool)
+for c in 'ATCGatcg':
+    BASES[ord(c)] = True
 
 
 def readFasta(infile):
@@ -9,13 +20,13 @@ def readFasta(infile):
     each key being the name of each sequence and the value being the
     sequence
 
-    @param infile: input fasta file
+    @param infile: input fasta file, plain or gzip compressed
     @return a dictionary
     '''
     output = {}
     trace = ""
     tmp = []
-    inH = open(infile)
+    inH = ReRCoP_bgzf.openInput(infile)
     for line in inH:
         line = line.strip('\n')
         if line.startswith(">"):
@@ -30,6 +41,180 @@ def readFasta(infile):
     return output
 
 
+def readAlignment(infile):
+    '''
+    This function reads in a fasta file of aligned sequences and returns an
+    Alignment, with the sequences stored as a 2-D uint8 array built directly
+    from the file content. Sequence names are parsed as in readFasta.
+
+    @param infile: input fasta file, plain or gzip compressed
+    @return an Alignment
+    '''
+    data = ReRCoP_bgzf.readAll(infile)
+
+    bounds = []
+    start = data.find('>')
+    while start != -1:
+        end = data.find('\n>', start)
+        if end == -1:
+            bounds.append([start, len(data)])
+            break
+        bounds.append([start, end + 1])
+        start = end + 1
+
+    names = []
+    seqs = None
+    for i in xrange(len(bounds)):
+        start, end = bounds[i]
+        lineEnd = data.find('\n', start, end)
+        if lineEnd == -1:
+            lineEnd = end
+        names.append(data[start:lineEnd].split(' ')[0].lstrip('>'))
+        body = data[lineEnd:end].replace('\n', '')
+        if seqs is None:
+            seqs = numpy.empty((len(bounds), len(body)), dtype=numpy.uint8)
+        if len(body) != seqs.shape[1]:
+            raise IOError("Different fasta sequence lengths! Please check!")
+        seqs[i] = numpy.frombuffer(body, dtype=numpy.uint8)
+    if seqs is None:
+        seqs = numpy.zeros((0, 0), dtype=numpy.uint8)
+    return ReRCoP_alignment.Alignment(names, seqs)
+
+
+def buildIndex(infile):
+    '''
+    This function scans a fasta file and returns its fasta index, which gives
+    for each sequence its name, its length, the byte offset of its first base,
+    the number of bases per line and the number of bytes per line. Sequence
+    names are parsed as in readFasta.
+
+    @param infile: input fasta file
+    @return a list of list [[name, length, offset, line bases, line width], ...]
+    '''
+    if ReRCoP_bgzf.isGzip(infile):
+        raise IOError("Compressed fasta file '%s' cannot be indexed!" % infile)
+    output = []
+    offset = 0
+    record = None
+    short = False
+    inH = open(infile, 'rb')
+    for line in inH:
+        if line.startswith('>'):
+            record = [line.rstrip('\r\n').split(' ')[0].lstrip('>'), 0, offset+len(line), 0, 0]
+            output.append(record)
+            short = False
+        elif record is not None:
+            bases = len(line.rstrip('\r\n'))
+            if record[3] == 0:
+                record[3] = bases
+                record[4] = len(line)
+            elif (short and bases > 0) or bases > record[3]:
+                inH.close()
+                raise IOError("Different line lengths in sequence '%s' of '%s', cannot be indexed!" % (record[0], infile))
+            if bases < record[3]:
+                short = True
+            record[1] += bases
+        offset += len(line)
+    inH.close()
+    return output
+
+
+def writeIndex(index, outfile):
+    '''
+    This function writes a fasta index in the tab-separated format of '.fai'
+    files.
+
+    @param index: the fasta index returned by buildIndex
+    @param outfile: output index file
+    '''
+    outH = open(outfile, 'w')
+    for item in index:
+        outH.write("%s\n" % "\t".join(map(str, item)))
+    outH.close()
+
+
+def readIndex(infile):
+    '''
+    This function reads in a '.fai' fasta index file.
+
+    @param infile: input index file
+    @return the fasta index as returned by buildIndex
+    '''
+    output = []
+    inH = open(infile)
+    for line in inH:
+        tmp = line.strip('\n').split('\t')
+        output.append([tmp[0]] + map(int, tmp[1:5]))
+    inH.close()
+    return output
+
+
+def faidx(infile, write=True):
+    '''
+    This function returns the fasta index of a fasta file. The index is cached
+    as '<infile>.fai', with the fingerprint of the fasta file it was built
+    from (see ReRCoP_checkpoint.fingerprint) in '<infile>.fai.key'. The index
+    is rebuilt if the fasta file changed since, or if it does not end where
+    the fasta file ends. An index without a fingerprint, e.g. from samtools,
+    is reused if it is not older than the fasta file.
+
+    @param infile: input fasta file
+    @param write: set this to cache a rebuilt index
+    @return the fasta index as returned by buildIndex
+    '''
+    indexFile = infile + '.fai'
+    keyFile = indexFile + '.key'
+    key = ReRCoP_checkpoint.fingerprint([infile], {})
+    if os.path.isfile(indexFile):
+        if os.path.isfile(keyFile):
+            inH = open(keyFile)
+            valid = inH.read().strip() == key
+            inH.close()
+        else:
+            valid = os.path.getmtime(indexFile) >= os.path.getmtime(infile)
+        if valid:
+            try:
+                index = readIndex(indexFile)
+            except (IndexError, ValueError):
+                index = []
+            inH = open(infile, 'rb')
+            valid = ReRCoP_alignment.indexMatches(index, inH)
+            inH.close()
+            if valid:
+                return index
+    index = buildIndex(infile)
+    if not write:
+        return index
+    try:
+        writeIndex(index, indexFile)
+        outH = open(keyFile, 'w')
+        outH.write("%s\n" % key)
+        outH.close()
+    except (IOError, OSError):
+        pass                            # The cache is optional
+    return index
+
+
+def readMapped(infile, index=None, write=True):
+    '''
+    This function opens a fasta file of aligned sequences as an Alignment
+    served from a memory map of the file. Files that cannot be indexed, or
+    that do not match the given index, are read into memory with
+    readAlignment instead.
+
+    @param infile: input fasta file
+    @param index: the fasta index of infile if already loaded
+    @param write: set this to cache the fasta index (see 'faidx')
+    @return an Alignment
+    '''
+    try:
+        if index is None:
+            index = faidx(infile, write)
+        return ReRCoP_alignment.MappedAlignment(infile, index)
+    except IOError:
+        return readAlignment(infile)
+
+
 def fastaLen(infasta):
     '''
     This function reads in the first sequence in a fasta object and returns the
@@ -38,6 +223,8 @@ def fastaLen(infasta):
     @param infasta: input fasta object
     @return: an int showing the sequence length
     '''
+    if isinstance(infasta, ReRCoP_alignment.Alignment):
+        return infasta.length
     key = infasta.keys()[0]
     return len(infasta[key])
 
@@ -47,14 +234,14 @@ def readGbk(infile):
     This function reads in a GenBank file and returns the locus tag, start position
     and end position of each gene binded together as a list of list
 
-    @param infile: input genbank file
+    @param infile: input genbank file, plain or gzip compressed
     @return: a list of list [[gene1.name, gene1.start, gene1.end], [gene2.name, 
     gene2.start, gene2.end], ...]
     '''
     output = []
     record = False
     pos = []
-    inH = open(infile)
+    inH = ReRCoP_bgzf.openInput(infile)
     for line in inH:
         line = line.strip()
         line = line.strip('\n')
@@ -79,23 +266,18 @@ def filterCore(inDict, covCut):
     This function filters the genes involved in the concatenation based on
     the cutoffs provided.
 
-    @param inDict: a dict with the gene sequences of a certain gene
+    @param inDict: a dict with the gene sequences of a certain gene, or a 2-D
+    uint8 array with one row per sequence
     @param covCut: a cutoff that if at least this percent of the positions
     in a gene sequence should be covered to be called present
     @return a boolean value of whether include the gene or not
     '''
-    passCov = 0
-    for item in inDict:
-        total = len(inDict[item])
-        count = 0
-        for c in inDict[item]:
-            if c in ['A', 'T', 'C', 'G', 'a', 't', 'c', 'g']:
-                count += 1
-        if count >= float(covCut) * total:
-            passCov += 1
-    if passCov == len(inDict):
-        return True
-    return False
+    if isinstance(inDict, numpy.ndarray):
+        block = inDict
+    else:
+        block = ReRCoP_alignment.toAlignment(inDict).seqs
+    count = BASES[block].sum(axis=1)
+    return bool((count >= float(covCut) * block.shape[1]).all())
 
 
 def slidingWindow(fullLen, fragSize, stepSize):
@@ -122,6 +304,98 @@ def slidingWindow(fullLen, fragSize, stepSize):
     return output
 
 
+def regionBounds(regions, length):
+    '''
+    This function clips alignment regions to an alignment length in the same
+    way as slicing the columns of an Alignment.
+
+    @param regions: a list of list [[start, end], ...] of 0-based start and
+    exclusive end positions
+    @param length: the alignment length
+    @return [starts, ends] as int64 arrays with 0 <= start <= end <= length
+    '''
+    bounds = numpy.array(regions, dtype=numpy.int64).reshape(-1, 2)
+    starts = numpy.clip(bounds[:, 0], 0, length)
+    ends = numpy.maximum(starts, numpy.minimum(bounds[:, 1], length))
+    return [starts, ends]
+
+
+def regionIndex(starts, ends):
+    '''
+    This function returns the alignment columns of a list of regions, one
+    region after the other.
+
+    @param starts: the 0-based start of each region
+    @param ends: the exclusive end of each region
+    @return a 1-D int64 array of column indices
+    '''
+    widths = ends - starts
+    index = numpy.ones(widths.sum(), dtype=numpy.int64)
+    # Each region starts with a jump from the last column of the previous one
+    firsts = numpy.cumsum(widths) - widths
+    nonEmpty = widths > 0
+    jumps = starts[nonEmpty] - numpy.concatenate([[0], ends[nonEmpty][:-1] - 1])
+    index[firsts[nonEmpty]] = jumps
+    return numpy.cumsum(index)
+
+
+def coreRegions(gbk, fasta, covCut):
+    '''
+    This function selects the genes of the genbank record that pass the
+    coverage cutoff in all the sequences, and returns their positions in the
+    alignment together with the concatenation record. The covered positions
+    of all the genes of a sequence are counted at once from a running count
+    along the sequence.
+
+    @param gbk: the record generated by readGbk
+    @param fasta: the record generated by readAlignment
+    @param covCut: the coverage cutoff for the function 'filterCore'
+    @return [regions, concatenation_log] with regions a list of list [[start,
+    end], ...] of the 0-based start and exclusive end of each kept gene
+    '''
+    aln = ReRCoP_alignment.toAlignment(fasta)
+    for i in xrange(len(gbk)):
+        gbk[i][1] = int(gbk[i][1])
+        gbk[i][2] = int(gbk[i][2])
+    [starts, ends] = regionBounds([[item[1]-1, item[2]] for item in gbk], aln.length)
+    need = float(covCut) * (ends - starts)
+    keep = numpy.ones(len(gbk), dtype=bool)
+    count = numpy.zeros(aln.length+1, dtype=numpy.int64)
+    for i in xrange(len(aln)):
+        numpy.cumsum(BASES[aln.row(i)], out=count[1:])
+        keep &= (count[ends] - count[starts]) >= need
+
+    log = []
+    current = 1
+    regions = []
+    for i in numpy.flatnonzero(keep):
+        regions.append([gbk[i][1]-1, gbk[i][2]])
+        log.append([gbk[i][0], current, gbk[i][2]-gbk[i][1]+current])
+        current = gbk[i][2]-gbk[i][1]+current+1
+    return [regions, log]
+
+
+def extractRegions(fasta, regions):
+    '''
+    This function concatenates the given alignment regions of every sequence,
+    taking all their columns in a single gather.
+
+    @param fasta: a fasta object or an Alignment
+    @param regions: a list of list [[start, end], ...] of 0-based start and
+    exclusive end positions
+    @return an Alignment
+    '''
+    aln = ReRCoP_alignment.toAlignment(fasta)
+    index = regionIndex(*regionBounds(regions, aln.length))
+    if isinstance(aln, ReRCoP_alignment.MappedAlignment):
+        seqs = numpy.empty((len(aln), len(index)), dtype=numpy.uint8)
+        for i in xrange(len(aln)):
+            seqs[i] = aln.row(i)[index]
+    else:
+        seqs = aln.seqs.take(index, axis=1)
+    return ReRCoP_alignment.Alignment(aln.names, seqs)
+
+
 def parseGbk(gbk, fasta, covCut):
     '''
     This function takes in the fasta record and the genbank record, which would
@@ -129,36 +403,138 @@ def parseGbk(gbk, fasta, covCut):
     fasta file which contains only the coding sequences and a concatenation record.
 
     @param gbk: the record generated by readGbk
-    @param fasta: the record generated by readFasta
+    @param fasta: the record generated by readAlignment
     @param covCut: the coverage cutoff for the function 'filterCore'
     @return [new_fasta, concatenation_log]
     '''
-    log = []
-    current = 1
-    outFa = {}
-    for seq in fasta:
-        outFa[seq] = ""
-    
-    for i in xrange(len(gbk)):
-        gbk[i][1] = int(gbk[i][1])
-        gbk[i][2] = int(gbk[i][2])
-        tmp = {}
-        for seq in fasta:
-            tmp[seq] = fasta[seq][gbk[i][1]-1:gbk[i][2]]
-        if filterCore(tmp, covCut):
-            for item in tmp:
-                outFa[item] += tmp[item]
-            log.append([gbk[i][0], current, gbk[i][2]-gbk[i][1]+current])
-            current = gbk[i][2]-gbk[i][1]+current+1
-    return[outFa, log]
+    [regions, log] = coreRegions(gbk, fasta, covCut)
+    return [extractRegions(fasta, regions), log]
+
+
+def parseHit(hit):
+    '''
+    This function lays out a hit along its query sequence. The subject bases
+    aligned to the query are placed at their query positions, with gaps where
+    the query is not covered, and the subject bases aligned to gaps in the
+    query are kept apart as insertions.
+
+    @param hit: a hit as returned by ReRCoP_blast.readHits
+    @return [body, insertions] with body a string as long as the query and
+    insertions a list of list [[position, bases], ...] giving the bases
+    inserted before each 0-based query position
+    '''
+    qseq = hit[9]
+    sseq = hit[10]
+    pieces = ['-'*(hit[3]-1)]
+    insertions = []
+    pos = hit[3]-1
+    last = 0
+    for match in re.finditer("-+", qseq):
+        pieces.append(sseq[last:match.start()])
+        pos += match.start()-last
+        insertions.append([pos, sseq[match.start():match.end()]])
+        last = match.end()
+    pieces.append(sseq[last:])
+    pos += len(sseq)-last
+    pieces.append('-'*(hit[1]-pos))
+    return ["".join(pieces), insertions]
+
+
+def mergeHit(storage, hit, simCut, covCut):
+    '''
+    This function adds the best hit of a gene in a genome to the gene storage
+    of parseRaw. The gene is dropped if the hit is too weak.
+
+    @param storage: a dict of dicts {gene: {"ref": reference, genome: [body,
+    insertions]}} with [body, insertions] as returned by parseHit
+    @param hit: a hit as returned by ReRCoP_blast.readHits
+    @param simCut: the similarity cutoff for defining the presence of a gene
+    @param covCut: the coverage cutoff for the function 'filterCore'
+    '''
+    trace = hit[0]
+    if (hit[8] * hit[7]) < (hit[1] * simCut *covCut):
+        del storage[trace]
+        return
+    storage[trace][hit[2]] = parseHit(hit)
+
+
+def mergeHits(storage, hits, simCut, covCut):
+    '''
+    This function adds the hits of one BLAST search against a genome to the
+    gene storage of parseRaw, using the first hit of each gene.
+
+    @param storage: the gene storage as described in 'mergeHit'
+    @param hits: the hits as returned by ReRCoP_blast.readHits
+    @param simCut: the similarity cutoff for defining the presence of a gene
+    @param covCut: the coverage cutoff for the function 'filterCore'
+    '''
+    trace = ""
+    for hit in hits:
+        if hit[0] == trace or hit[0] not in storage:
+            continue
+        trace = hit[0]
+        mergeHit(storage, hit, simCut, covCut)
 
 
-def parseRaw(cds, seq, simCut, covCut, tmpFile1, tmpFile2, tmpFile3):
+def assembleGene(entry, genomes):
+    '''
+    This function merges the hits of one gene in all the genomes into aligned
+    sequences, applying all the insertions at once. Each query position where
+    some genome has inserted bases gets a block of columns as wide as the
+    longest insertion, filled with 'N' in the reference and padded with gaps
+    in the other genomes.
+
+    @param entry: the storage of the gene as described in 'mergeHit'
+    @param genomes: the genome names
+    @return [reference, rows] with rows a dict of the aligned sequence of
+    each genome
+    '''
+    width = {}
+    for genome in genomes:
+        for [pos, bases] in entry[genome][1]:
+            width[pos] = max(width.get(pos, 0), len(bases))
+    cuts = sorted(width)
+
+    ref = entry['ref']
+    pieces = []
+    last = 0
+    for pos in cuts:
+        pieces.append(ref[last:pos])
+        pieces.append('N'*width[pos])
+        last = pos
+    pieces.append(ref[last:])
+    reference = "".join(pieces)
+
+    rows = {}
+    for genome in genomes:
+        [body, insertions] = entry[genome]
+        inserted = dict((pos, bases) for [pos, bases] in insertions)
+        pieces = []
+        last = 0
+        for pos in cuts:
+            pieces.append(body[last:pos])
+            pieces.append(inserted.get(pos, '').ljust(width[pos], '-'))
+            last = pos
+        pieces.append(body[last:])
+        rows[genome] = "".join(pieces)
+    return [reference, rows]
+
+
+def parseRaw(cds, seq, simCut, covCut, tmpFile1, tmpFile2, tmpFile3, threads=1, combined=False, cache=None, profile=None):
     '''
     This function extracts the core genome from the seququences based on the cds
     provided and returns the concatenated core genome file and the concatenation
     log.
 
+    All the genomes are searched against the same coding sequences, so the
+    searches are independent: with several threads they run in a worker pool,
+    and with combined set all the genomes are put in one database that is
+    searched once by a multi-threaded blastn. The hits are merged per gene
+    (see 'assembleGene') once all the genomes have been searched. With a
+    cache, databases and hits from earlier runs are reused and only the
+    missing searches are run. Genes without a hit in every genome are not
+    part of the core genome.
+
     @param cds: a fasta object of the gene coding sequences for consideration
     @param seq: a fasta object of the genome sequences for to extract the core
     genome
@@ -167,133 +543,117 @@ def parseRaw(cds, seq, simCut, covCut, tmpFile1, tmpFile2, tmpFile3):
     @param tmpFile1: a file that can write the tmp cds information into
     @param tmpFile2: a file that can write the tmp genome information into
     @param tmpFile3: a file that can write the tmp output information into
+    @param threads: the number of BLAST searches to run at the same time, or
+    the number of blastn threads if combined is set
+    @param combined: set this to search all the genomes in a single database
+    @param cache: a ReRCoP_blast.BlastCache, or None to search every genome
+    @param profile: a ReRCoP_profile.Profile to report the progress and the
+    number of BLAST hits to
     @return [core_fasta, concatenation_log]
     '''
 
     storage = {}
-
-    cdsH = open(tmpFile1, "w")
     for gene in cds:
-        cdsH.write(">%s\n" % gene)
-        cdsH.write("%s\n" % cds[gene])
         storage[gene] = {"ref":cds[gene]}
-    cdsH.close()
-
-    for genome in seq:
-        tmpH = open(tmpFile2,'w')
-        tmpH.write(">%s\n" % genome)
-        tmpH.write("%s\n" % seq[genome])
-        tmpH.close()
-
-        subprocess.call(["makeblastdb", "-in", tmpFile2, "-out", tmpFile2, "-dbtype", "nucl"])
-        subprocess.call(["blastn", "-query", tmpFile1, "-db", tmpFile2, "-task", "blastn", "-outfmt", "6 qseqid qlen sseqid qstart qend sstart send length pident qseq sseq", "-max_target_seqs", "1", "-out", tmpFile3])
-        
-        trace = ""
-        inH = open(tmpFile3)
-        for line in inH:
-            line = line.strip('\n')
-            tmp = line.split('\t')
-            tmp[1] = int(tmp[1])
-            tmp[3] = int(tmp[3])
-            tmp[4] = int(tmp[4])
-            tmp[7] = int(tmp[7])
-            tmp[8] = float(tmp[8])
-    
-            if tmp[0] == trace or tmp[0] not in storage:
-                continue
-            trace = tmp[0]
-            if (tmp[8] * tmp[7]) < (tmp[1] * simCut *covCut):
-                del storage[trace]
-                continue
-
-            gap = [match.start() for match in re.finditer("-", tmp[9])]
-            if len(gap) == 0:
-                if tmp[1] == tmp[7]:
-                    storage[trace][tmp[2]]=tmp[10]
-                elif tmp[1] > tmp[7]:
-                    tmpStr = ""
-                    for i in range(1,tmp[3]):
-                        tmpStr += '-'
-                    tmpStr += tmp[10]
-                    for i in range(tmp[4],tmp[1]):
-                        tmpStr += '-'
-                    storage[trace][tmp[2]] = tmpStr
-            else:
-                # Modify the reference sequence
-                for key in storage[trace]:
-                    for ind in gap:
-                        storage[trace][key] = storage[trace][key][:ind] + 'N' + storage[trace][key][ind:]
-
-                tmpStr = ""
-                if tmp[3] != 1 or tmp[4] != tmp[2]:
-                    for i in range(1,tmp[3]):
-                        tmpStr += '-'
-                    tmpStr += tmp[10]
-                    for i in range(tmp[4],tmp[1]):
-                        tmpStr += '-'
-                else:
-                    tmpStr = tmp[10]
-
-                storage[trace][tmp[2]] = tmpStr
-
-                # Build the reference again
-                cdsH = open(tmpFile1, "w")
-                for gene in storage:
-                    cdsH.write(">%s\n" % gene)
-                    cdsH.write("%s\n" % storage[gene]['ref'])
-                cdsH.close()
-        inH.close()
-
-    output = {}
+    ReRCoP_blast.writeSeq(cds, tmpFile1)
+
+    genomes = list(seq)
+    tasks = [[genomes[i], seq[genomes[i]], tmpFile1, "%s.%d" % (tmpFile2, i), "%s.%d" % (tmpFile3, i), cache] for i in xrange(len(genomes))]
+
+    pool = None
+    done = False
+    try:
+        if combined:
+            missing = range(len(genomes))
+            if cache is not None:
+                missing = [i for i in missing if not cache.fetch(tmpFile1, seq[genomes[i]], tasks[i][4], genomes[i], 'combined')]
+            if len(missing) > 0:
+                ReRCoP_blast.blastCombined(seq, [genomes[i] for i in missing], tmpFile1, tmpFile2, [tasks[i][4] for i in missing], threads)
+            if cache is not None:
+                for i in missing:
+                    cache.store(tmpFile1, seq[genomes[i]], tasks[i][4], 'combined')
+        elif threads > 1:
+            pool = multiprocessing.Pool(threads)
+            results = pool.imap(ReRCoP_blast.blastGenome, tasks)
+
+        for i in xrange(len(genomes)):
+            [genome, _, query, db, hitFile, _] = tasks[i]
+            if pool is not None:
+                results.next()
+            elif not combined:
+                ReRCoP_blast.blastGenome(tasks[i])
+            hits = ReRCoP_blast.readHits(hitFile)
+            mergeHits(storage, hits, simCut, covCut)
+            if profile is not None:
+                profile.add('BLAST hits', len(hits))
+                profile.progress('genomes', i+1, len(genomes))
+
+            if cache is None and not combined:
+                ReRCoP_blast.removeDb(db)
+                os.remove(db)
+            os.remove(hitFile)
+        done = True
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.evict()
+        if not done:
+            # Do not leave the files of a failed search behind
+            for [_, _, _, db, hitFile, _] in tasks:
+                if cache is None and not combined:
+                    ReRCoP_blast.removeDb(db)
+                    if os.path.isfile(db):
+                        os.remove(db)
+                for outfile in [hitFile, hitFile + '.raw']:
+                    if os.path.isfile(outfile):
+                        os.remove(outfile)
+            if os.path.isfile(tmpFile1):
+                os.remove(tmpFile1)
+
+    pieces = dict((genome, []) for genome in genomes)
     log = []
     tmpPos = 1
     for gene in storage:
-        log.append([gene, tmpPos, tmpPos+len(storage[gene]['ref'])-1])
-        tmpPos += len(storage[gene]['ref'])
-
-        for key in storage[gene]:
-            if key != "ref":
-                if key in output:
-                    output[key] += storage[gene][key]
-                else:
-                    output[key] = storage[gene][key]
+        if not all(genome in storage[gene] for genome in genomes):
+            continue
+        [reference, rows] = assembleGene(storage[gene], genomes)
+        log.append([gene, tmpPos, tmpPos+len(reference)-1])
+        tmpPos += len(reference)
+        for genome in genomes:
+            pieces[genome].append(rows[genome])
+    output = dict((genome, "".join(pieces[genome])) for genome in genomes)
 
     os.remove(tmpFile1)
-    os.remove(tmpFile2)
-    os.remove(tmpFile3)
-    os.remove(tmpFile2+".nsq")
-    os.remove(tmpFile2+".nin")
-    os.remove(tmpFile2+".nhr")
 
     return [output, log]
 
 
-def consensus(inFasta):
+def baseCounts(inFasta):
     '''
-    This function generates the consensus sequence from multiple fasta sequences
-    alignments and returns as a fasta object.
+    This function counts the characters in each column of multiple fasta
+    sequences alignments, one block of columns at a time.
 
-    @param inFasta: a fasta object of multiple sequences alignments
-    @return consensusSeq
+    @param inFasta: a fasta object or an Alignment of multiple sequences alignments
+    @return a BaseCounts object
     '''
+    aln = ReRCoP_alignment.toAlignment(inFasta)
+    counts = ReRCoP_alignment.BaseCounts(aln.length)
+    width = ReRCoP_alignment.blockWidth(len(aln))
+    for start in xrange(0, aln.length, width):
+        counts.add(aln.columns(start, start+width), start)
+    return counts
 
-    storage = []
-    initialize = True
-    consense = ""
-    for key in inFasta:
-        if initialize:
-            for i in range(len(inFasta[key])):
-                storage.append({inFasta[key][i]:1})
-            initialize = False
-        else:
-            for i in range(len(inFasta[key])):
-                if inFasta[key][i] in storage[i]:
-                    storage[i][inFasta[key][i]] += 1
-                else:
-                    storage[i][inFasta[key][i]] = 1
 
-    for i in range(len(storage)):
-        key, _ = max(storage[i].iteritems(), key=lambda x:x[1])
-        consense += key
+def consensus(inFasta):
+    '''
+    This function generates the consensus sequence from multiple fasta sequences
+    alignments and returns it together with the per-column character counts.
 
-    return consense
+    @param inFasta: a fasta object or an Alignment of multiple sequences alignments
+    @return [consensusSeq, counts] with consensusSeq a uint8 array and counts
+    the BaseCounts object it was derived from
+    '''
+    counts = baseCounts(inFasta)
+    return [counts.consensus(), counts]
@@ -0,0 +1,137 @@
+import sys
+import time
+import json
+import resource
+
+
+def usage(who):
+    '''
+    This function returns the CPU time and the peak resident memory used so
+    far by the process or by its finished child processes (e.g. BLAST).
+
+    @param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    @return [CPU seconds, peak memory in MB]
+    '''
+    rusage = resource.getrusage(who)
+    return [rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024.0]
+
+
+class Profile(object):
+    '''
+    This class records the wall time, CPU time, peak memory and item counts
+    of the successive stages of a run, and logs the progress of the long
+    loops of a stage every given number of items.
+
+    A stage lasts from the call to 'stage' until the next one or 'finish'.
+    Functions with a 'profile' parameter report their progress and counts to
+    it when one is given.
+    '''
+
+    def __init__(self, interval=0):
+        '''
+        @param interval: log the progress of a loop every this many items, or
+        never if 0
+        '''
+        self.interval = interval
+        self.stages = []
+        self.counts = {}
+        self.current = None
+        self.last = {}
+        self.start = time.time()
+        self.begin = [self.start, usage(resource.RUSAGE_SELF)[0], usage(resource.RUSAGE_CHILDREN)[0]]
+
+    def stage(self, name):
+        '''
+        This function ends the current stage, if any, and starts a new one.
+
+        @param name: the stage name
+        '''
+        self.finish()
+        self.current = {'name':name, 'counts':{}}
+        self.last = {}
+        self.begin = [time.time(), usage(resource.RUSAGE_SELF)[0], usage(resource.RUSAGE_CHILDREN)[0]]
+
+    def finish(self):
+        '''
+        This function ends the current stage, if any.
+        '''
+        if self.current is None:
+            return
+        [cpu, peak] = usage(resource.RUSAGE_SELF)
+        [childCpu, childPeak] = usage(resource.RUSAGE_CHILDREN)
+        self.current['wall'] = time.time() - self.begin[0]
+        self.current['cpu'] = cpu - self.begin[1]
+        self.current['childCpu'] = childCpu - self.begin[2]
+        self.current['peakMB'] = peak
+        self.current['childPeakMB'] = childPeak
+        self.stages.append(self.current)
+        self.current = None
+
+    def count(self, key, value):
+        '''
+        This function sets an item count of the run and of the current stage.
+
+        @param key: the count name, e.g. 'genomes'
+        @param value: the count
+        '''
+        self.counts[key] = value
+        if self.current is not None:
+            self.current['counts'][key] = value
+
+    def add(self, key, value):
+        '''
+        This function adds to an item count of the run and of the current
+        stage.
+        '''
+        self.counts[key] = self.counts.get(key, 0) + value
+        if self.current is not None:
+            self.current['counts'][key] = self.current['counts'].get(key, 0) + value
+
+    def progress(self, unit, done, total):
+        '''
+        This function logs the progress of a loop whenever another interval
+        of items has been done, and when the loop is done.
+
+        @param unit: the name of the items, e.g. 'genomes'
+        @param done: the number of items done so far
+        @param total: the total number of items
+        '''
+        if self.interval <= 0:
+            return
+        last = self.last.get(unit, 0)
+        self.last[unit] = done
+        if done // self.interval == last // self.interval and done < total:
+            return
+        name = self.current['name'] if self.current is not None else 'run'
+        print "[%s] %d/%d %s (%.1f s)" % (name, done, total, unit, time.time() - self.start)
+        sys.stdout.flush()
+
+    def report(self):
+        '''
+        This function returns the record of the run, ending the current stage.
+
+        @return a dict
+        '''
+        self.finish()
+        [cpu, peak] = usage(resource.RUSAGE_SELF)
+        [childCpu, childPeak] = usage(resource.RUSAGE_CHILDREN)
+        return {'command':sys.argv,
+                'start':time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+                'wall':time.time() - self.start,
+                'cpu':cpu,
+                'childCpu':childCpu,
+                'peakMB':peak,
+                'childPeakMB':childPeak,
+                'counts':self.counts,
+                'stages':self.stages}
+
+    def write(self, outfile):
+        '''
+        This function writes the record of the run in JSON format.
+
+        @param outfile: output JSON file
+        '''
+        outH = open(outfile, 'w')
+        json.dump(self.report(), outH, indent=2, sort_keys=True)
+        outH.write("\n")
+        outH.close()
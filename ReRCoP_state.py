@@ -0,0 +1,144 @@
+import os
+import numpy
+import ReRCoP_alignment
+import ReRCoP_bgzf
+import ReRCoP_matrix
+import ReRCoP_preprocessing
+
+
+def saveState(outfile, names, log, regions, counts, diff, core):
+    '''
+    This function saves what is needed to add genomes to a run later on: the
+    per-column character counts of the core alignment, the concatenation log
+    and the number of differences from the consensus in each region of each
+    genome.
+
+    @param outfile: output file in NumPy '.npz' format
+    @param names: the genome names in the row order of diff
+    @param log: the concatenation log
+    @param regions: the alignment regions of the input making up the core
+    alignment, as returned by ReRCoP_preprocessing.coreRegions, or None if
+    the input was not aligned
+    @param counts: the BaseCounts of the core alignment
+    @param diff: the array returned by ReRCoP_matrix.regionDiff
+    @param core: the fasta file of the core alignment
+    '''
+    if regions is None:
+        regions = numpy.zeros((0, 2), dtype=numpy.int64)
+    outH = open(outfile, 'wb')
+    numpy.savez(outH,
+                names=numpy.array(names, dtype=str),
+                logName=numpy.array([str(item[0]) for item in log], dtype=str),
+                logPos=numpy.array([[int(item[1]), int(item[2])] for item in log], dtype=numpy.int64).reshape(-1, 2),
+                regions=numpy.array(regions, dtype=numpy.int64).reshape(-1, 2),
+                alphabet=counts.alphabet,
+                counts=counts.counts,
+                diff=diff,
+                core=numpy.array(os.path.abspath(core)))
+    outH.close()
+
+
+def loadState(infile):
+    '''
+    This function reads in a state saved by 'saveState'.
+
+    @param infile: input state file
+    @return a dict with the keys 'names', 'log', 'regions', 'counts', 'diff'
+    and 'core' as given to 'saveState'
+    '''
+    data = numpy.load(infile)
+    counts = ReRCoP_alignment.BaseCounts(0)
+    counts.alphabet = data['alphabet']
+    counts.counts = data['counts']
+    log = [[name, int(pos[0]), int(pos[1])] for name, pos in zip(data['logName'].tolist(), data['logPos'])]
+    state = {'names':data['names'].tolist(),
+             'log':log,
+             'regions':data['regions'].tolist(),
+             'counts':counts,
+             'diff':data['diff'],
+             'core':str(data['core'])}
+    data.close()
+    return state
+
+
+def update(state, inFasta, core, compress=False, threads=1):
+    '''
+    This function adds new genomes to a saved state. The new genomes are
+    folded into the per-column character counts, and the differences of the
+    genomes already in the state are corrected only in the columns whose
+    consensus changed, reading just those columns of the previous core
+    alignment. Only the new genomes are compared in full. The state is
+    updated in place and the core alignment with the new genomes appended is
+    written to the given file.
+
+    @param state: the state returned by 'loadState'
+    @param inFasta: an Alignment of the new genomes, aligned in the same way
+    as the input of the saved run
+    @param core: output fasta file of the updated core alignment, which may
+    be the core alignment of the saved state
+    @param compress: write the core alignment in BGZF format
+    @param threads: the number of compressing threads
+    @return the updated core Alignment
+    '''
+    if len(state['regions']) == 0:
+        raise IOError("The saved state is from genomes that were not aligned and cannot be updated!")
+    for name in inFasta.names:
+        if name in state['names']:
+            raise IOError("Genome '%s' is already in the saved state!" % name)
+    counts = state['counts']
+    newCore = ReRCoP_preprocessing.extractRegions(inFasta, state['regions'])
+    if newCore.length != counts.counts.shape[0]:
+        raise IOError("The new genomes are not aligned in the same way as the saved state!")
+
+    before = counts.consensus()
+    width = ReRCoP_alignment.blockWidth(len(newCore))
+    for start in xrange(0, newCore.length, width):
+        counts.add(newCore.columns(start, start+width), start)
+    after = counts.consensus()
+    changed = numpy.flatnonzero(before != after)
+
+    diff = state['diff']
+    if len(changed) > 0:
+        oldCore = ReRCoP_preprocessing.readMapped(state['core'])
+        [starts, ends] = ReRCoP_matrix.regionBounds(state['log'])
+        lo = numpy.searchsorted(changed, starts)
+        hi = numpy.searchsorted(changed, ends)
+        index = numpy.zeros(len(changed)+1, dtype=numpy.int64)
+        beforeChanged = before[changed]
+        afterChanged = after[changed]
+        for i, name in enumerate(state['names']):
+            bases = oldCore.row(oldCore.index[name])[changed]
+            delta = (bases != afterChanged).astype(numpy.int64) - (bases != beforeChanged)
+            numpy.cumsum(delta, out=index[1:])
+            diff[i] += index[hi] - index[lo]
+    newDiff = ReRCoP_matrix.regionDiff(state['log'], newCore, after)
+
+    # Append the new genomes to a copy of the core alignment, which is
+    # written out again if it is not in the output format
+    if ReRCoP_bgzf.isGzip(state['core']) == compress:
+        inH = open(state['core'], 'rb')
+        outH = open(core + '.tmp', 'wb')
+        for chunk in iter(lambda: inH.read(1<<24), ''):
+            outH.write(chunk)
+        inH.close()
+        outH.close()
+        outH = ReRCoP_bgzf.openOutput(core + '.tmp', compress, threads, True)
+    else:
+        oldCore = ReRCoP_preprocessing.readMapped(state['core'])
+        outH = ReRCoP_bgzf.openOutput(core + '.tmp', compress, threads)
+        for i, name in enumerate(oldCore.names):
+            outH.write(">%s\n" % name)
+            outH.write("%s\n" % oldCore.row(i).tostring())
+    for i, name in enumerate(newCore.names):
+        outH.write(">%s\n" % name)
+        outH.write("%s\n" % newCore.row(i).tostring())
+    outH.close()
+    os.rename(core + '.tmp', core)
+    for indexFile in [core + '.fai', core + '.fai.key']:
+        if os.path.isfile(indexFile):
+            os.remove(indexFile)
+
+    state['names'] = state['names'] + newCore.names
+    state['diff'] = numpy.vstack([diff, newDiff])
+    state['core'] = os.path.abspath(core)
+    return ReRCoP_preprocessing.readMapped(core)
@@ -0,0 +1,176 @@
+import itertools
+import multiprocessing
+import numpy
+import ReRCoP_outlierDetection
+
+
+# The parameters of each outlier removal method that can be swept
+PARAMETERS = {'Grubbs':['alpha'], 'kNN':['k', 'radius'], 'DBSCAN':['eps', 'minP']}
+
+# The parameters in the column order of the sweep summary
+COLUMNS = ['alpha', 'k', 'radius', 'eps', 'minP']
+
+# The SNP matrix and region bounds used by 'sweepTask'. They are set by
+# 'sweep' before the worker processes are forked, so that the processes
+# share them read-only instead of receiving a copy with each task.
+shared = {}
+
+
+def parseGrid(text):
+    '''
+    This function parses the parameter grid of the --sweep option, e.g.
+    'alpha=0.01,0.05;k=0.1,0.2;radius=1,1.5'.
+
+    @param text: the grid as 'name=value,value,...' separated by ';'
+    @return a dict of the list of values of each parameter
+    '''
+    grid = {}
+    for item in text.split(';'):
+        if not item.strip():
+            continue
+        if '=' not in item:
+            raise ValueError("Option --sweep should be given as 'name=value,value;name=value,...'.")
+        [name, values] = item.split('=', 1)
+        name = name.strip()
+        if name not in COLUMNS:
+            raise ValueError("Option --sweep can only set 'alpha', 'k', 'radius', 'eps' and 'minP'.")
+        try:
+            grid[name] = [float(value) for value in values.split(',')]
+        except ValueError:
+            raise ValueError("Option --sweep should give numbers for '%s'." % name)
+        for value in grid[name]:
+            if value < 0 or (name in ['alpha', 'k', 'minP'] and value > 1):
+                raise ValueError("Option --sweep has a value of '%s' out of range." % name)
+    if len(grid) == 0:
+        raise ValueError("Option --sweep should set at least one parameter.")
+    return grid
+
+
+def combinations(methods, grid, config):
+    '''
+    This function lists the parameter combinations of each method. Each
+    method only varies its own parameters, the ones not in the grid keeping
+    their value in config.
+
+    @param methods: the outlier removal methods
+    @param grid: the grid returned by 'parseGrid'
+    @param config: a dict of option values
+    @return a list of list [[method, params], ...] with params a dict of the
+    parameter values of the method
+    '''
+    output = []
+    for method in methods:
+        names = PARAMETERS[method]
+        values = [grid.get(name, [config[name]]) for name in names]
+        for combo in itertools.product(*values):
+            output.append([method, dict(zip(names, combo))])
+    return output
+
+
+def outlierMask(mat, method, params, iterative=False):
+    '''
+    This function runs one outlier removal method with the given parameters.
+
+    @param mat: the SNP array returned by ReRCoP_matrix.snpArray
+    @param method: 'Grubbs', 'kNN' or 'DBSCAN'
+    @param params: the parameter values of the method
+    @param iterative: repeat the Grubbs test on the remaining points
+    @return a 2-D boolean array of outliers with the shape of mat
+    '''
+    if method == 'Grubbs':
+        return ReRCoP_outlierDetection.outlierMats(mat, [method], alpha=params['alpha'], iterative=iterative)[method]
+    if method == 'kNN':
+        return ReRCoP_outlierDetection.outlierMats(mat, [method], Pk=params['k'], Pthreshold=params['radius'])[method]
+    minP = params['minP']
+    if not minP:
+        minP = mat.shape[1]*0.3
+    return ReRCoP_outlierDetection.outlierMats(mat, [method], Peps=params['eps'], PminP=minP)[method]
+
+
+def maskedLength(mask, starts, ends):
+    '''
+    This function counts the alignment positions of each genome that are
+    covered by its outlier regions, counting overlapping regions once.
+
+    @param mask: a 2-D boolean array of outliers, one row per region and one
+    column per genome
+    @param starts: the 0-based start of each region
+    @param ends: the exclusive end of each region
+    @return an int array with the number of masked positions of each genome
+    '''
+    order = numpy.argsort(starts, kind='mergesort')
+    mask = mask[order]
+    starts = starts[order][:, None].astype(numpy.int64)
+    ends = ends[order][:, None].astype(numpy.int64)
+    # The furthest end of the outlier regions before each region
+    reach = numpy.maximum.accumulate(numpy.where(mask, ends, 0), axis=0)
+    before = numpy.vstack([numpy.zeros((1, mask.shape[1]), dtype=numpy.int64), reach[:-1]])
+    return numpy.where(mask, numpy.maximum(ends - numpy.maximum(starts, before), 0), 0).sum(axis=0)
+
+
+def sweepTask(task):
+    '''
+    This function runs one combination of a sweep on the shared SNP array.
+
+    @param task: [method, params] as returned by 'combinations'
+    @return [outliers, masked] with the number of outlier regions and of
+    masked positions of each genome
+    '''
+    [method, params] = task
+    mask = outlierMask(shared['mat'], method, params, shared['iterative'])
+    return [mask.sum(axis=0), maskedLength(mask, shared['starts'], shared['ends'])]
+
+
+def sweep(mat, combos, starts, ends, iterative=False, threads=1):
+    '''
+    This function runs all the combinations of a sweep on the same SNP array,
+    in a pool of worker processes if threads > 1.
+
+    @param mat: the SNP array returned by ReRCoP_matrix.snpArray
+    @param combos: the combinations returned by 'combinations'
+    @param starts: the 0-based start of each region
+    @param ends: the exclusive end of each region
+    @param iterative: repeat the Grubbs test on the remaining points
+    @param threads: the number of worker processes
+    @return a list of the results of 'sweepTask', in the order of combos
+    '''
+    shared.update({'mat':mat, 'starts':starts, 'ends':ends, 'iterative':iterative})
+    # Compute the critical values of the Grubbs tests on all the points before
+    # forking, so that the worker processes do not each import SciPy for them
+    for [method, params] in combos:
+        if method == 'Grubbs':
+            ReRCoP_outlierDetection.criticalValue(mat.shape[1], params['alpha'])
+    pool = None
+    try:
+        if threads > 1 and len(combos) > 1:
+            pool = multiprocessing.Pool(min(threads, len(combos)))
+            results = pool.map(sweepTask, combos, 1)
+        else:
+            results = map(sweepTask, combos)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shared.clear()
+    return results
+
+
+def writeSummary(outfile, combos, results, names, length):
+    '''
+    This function writes the summary of a sweep: for each combination its ID,
+    method and parameters, the total number of outliers, the fraction of the
+    alignment masked and the number of outliers of each genome.
+
+    @param outfile: output tab-separated file
+    @param combos: the combinations returned by 'combinations'
+    @param results: the results returned by 'sweep'
+    @param names: the genome names in the column order of the SNP array
+    @param length: the length of the core alignment
+    '''
+    outH = open(outfile, 'w')
+    outH.write("\t".join(["ID", "Method"] + COLUMNS + ["Outliers", "Masked"] + list(names)) + "\n")
+    for i, [[method, params], [outliers, masked]] in enumerate(zip(combos, results)):
+        values = ["%g" % params[name] if name in params else "-" for name in COLUMNS]
+        fraction = float(masked.sum()) / (len(names) * length) if len(names) * length > 0 else 0.0
+        outH.write("\t".join([str(i+1), method] + values + [str(int(outliers.sum())), "%.6f" % fraction] + [str(int(item)) for item in outliers]) + "\n")
+    outH.close()